@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+import json, os, sys, csv, time, random, argparse, tempfile, shutil, contextlib, io
+import combat_tracker as ct
+
+# Repository paths
+ROOT = os.path.dirname(os.path.abspath(__file__))
+MONSTERS_CSV = os.path.join(ROOT, 'data', 'monsters.csv')
+SPELLS_JSON = os.path.join(ROOT, 'data', 'spells.json')
+BASELINE = os.path.join(ROOT, 'benchmark_baseline.json')
+
+# Catalog scales and encounter sizes
+CATALOG_SCALES = [1, 10, 100]
+ENCOUNTER_SIZES = [10, 100, 1000, 10000]
+DRAW_SIZES = [10, 100, 1000]
+
+# Terminal size the renderer sees, shutil reads these before the real terminal
+TERMINAL = {'COLUMNS' : '120', 'LINES' : '50'}
+
+# Fixed inputs
+ROLLS = ['2d8+2', '18d10+54', '4d6kh3', '1d20+5', '10d6*2+1d4-3', '3d6']
+MONSTER_QUERIES = [
+    ['monster', 'name', 'goblin'],
+    ['monster', 'cr', '1/2'],
+    ['monster', 'cr', '2..5', 'type', 'undead', 'size', 'L', 'ac', '>=15'],
+    ['monster', 'hp', '>200', 'cr', '<15']
+]
+SPELL_QUERIES = [
+    ['spell', 'class', 'wizard', 'level', '3'],
+    ['spell', 'name', 'fire'],
+    ['spell', 'school', 'evocation', 'or', 'ritual'],
+    ['spell', 'all']
+]
+TEXT_QUERIES = [
+    ['text', 'radiant', 'damage'],
+    ['text', 'difficult', 'terrain', 'level', '2'],
+    ['text', 'saving', 'throw', 'class', 'wizard', 'or', 'text', 'necrotic']
+]
+TYPOS = ['beholdr', 'gobin', 'ancient_red_dragn', 'zombi', 'owlbaer']
+
+# Median wall time of fn over repeats, setup runs untimed before each call
+def measure(fn, repeats, setup=None):
+    times = []
+    for _ in range(repeats):
+        if setup:
+            setup()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2]
+
+# Pure python loop used to normalize results across machines
+def calibrate():
+    def loop():
+        total = 0
+        for i in range(200000):
+            total = total + i % 7
+        return total
+    return measure(loop, 5)
+
+# Write a monster catalog with every row repeated scale times under new names
+def scaled_monsters(directory, scale):
+    path = os.path.join(directory, f'monsters_{scale}x.csv')
+    with open(MONSTERS_CSV, newline='') as f:
+        rows = list(csv.reader(f))
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(rows[0])
+        for copy in range(scale):
+            for row in rows[1:]:
+                writer.writerow([row[0] if copy == 0 else f'{row[0]}-{copy}'] + row[1:])
+    return path
+
+# Write a spell pack with every spell repeated scale times under new names
+def scaled_spells(directory, scale):
+    path = os.path.join(directory, f'spells_{scale}x.json')
+    with open(SPELLS_JSON) as f:
+        spells = json.load(f)
+    scaled = []
+    for copy in range(scale):
+        for spell in spells:
+            scaled.append(dict(spell, name=spell['name'] if copy == 0 else f'{spell["name"]} {copy}'))
+    with open(path, 'w') as f:
+        json.dump(scaled, f, indent=4)
+    return path
+
+# Remove caches built from a data file
+def drop_caches(path):
+    for suffix in ('.cache', '.index', '.cards', '.fuzzy', '.text'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+# Encounter of n copies of a monster
+def make_encounter(n, name='Skeleton'):
+    combatants = ct.Encounter()
+    for _ in range(n):
+        ct.add_combatant(ct.Combatant(name, 2, 13, 13, 'Undead'), combatants)
+    return combatants
+
+# Run every benchmark, returns {name : seconds}
+def run(quick=False, repeats=5):
+    results = {}
+    scales = CATALOG_SCALES[:2] if quick else CATALOG_SCALES
+    sizes = ENCOUNTER_SIZES[:3] if quick else ENCOUNTER_SIZES
+    directory = tempfile.mkdtemp(prefix='ct_bench_')
+    cwd = os.getcwd()
+    environ = dict(os.environ)
+    os.environ.update(TERMINAL)
+
+    try:
+        random.seed(0)
+
+        # Catalog startup, cold builds the caches that warm runs load
+        for scale in scales:
+            monsters = scaled_monsters(directory, scale)
+            spells = scaled_spells(directory, scale)
+            count = 1 if scale == 100 else repeats
+
+            results[f'populate_monsters_cold_{scale}x'] = measure(
+                lambda : ct.populate_monsters(monsters, ct.MonsterDB()), count, lambda : drop_caches(monsters))
+            results[f'populate_monsters_warm_{scale}x'] = measure(
+                lambda : ct.populate_monsters(monsters, ct.MonsterDB()), repeats)
+            results[f'populate_spells_cold_{scale}x'] = measure(
+                lambda : ct.populate_spells(spells, ct.SpellStore()), count, lambda : drop_caches(spells))
+            results[f'populate_spells_warm_{scale}x'] = measure(
+                lambda : ct.populate_spells(spells, ct.SpellStore()), repeats)
+
+        # Shared databases for the query benchmarks
+        monster_db = ct.MonsterDB()
+        ct.populate_monsters(MONSTERS_CSV, monster_db)
+        spell_db = ct.SpellStore()
+        ct.populate_spells(SPELLS_JSON, spell_db)
+
+        # Dice
+        results['parse_roll_10000'] = measure(
+            lambda : [ct.parse_roll(ROLLS[i % len(ROLLS)]) for i in range(10000)], repeats)
+        results['roll_batch_10000'] = measure(
+            lambda : [ct.roll_batch(roll, 10000) for roll in ROLLS], repeats)
+
+        # Encounter building and rounds
+        for n in sizes:
+            results[f'add_combatant_{n}'] = measure(lambda : make_encounter(n), repeats)
+            combatants = make_encounter(n)
+            results[f'advance_round_{n}'] = measure(lambda : ct.advance_round(combatants), repeats)
+        for n in DRAW_SIZES:
+            combatants = make_encounter(n)
+            results[f'draw_all_{n}'] = measure(lambda : ct.draw_all(combatants), repeats)
+
+            # Full repaints and single row diffs on a pinned terminal size
+            renderer = ct.TableRenderer(io.StringIO())
+            def redraw():
+                combatants[0].health = combatants[0].health - 1
+                renderer.draw(combatants)
+            redraw()
+            results[f'renderer_redraw_{n}'] = measure(redraw, repeats)
+            results[f'renderer_repaint_{n}'] = measure(redraw, repeats, renderer.invalidate)
+
+        # Encounter files, 40 catalog creatures and a large custom one
+        os.makedirs(os.path.join(directory, 'data'), exist_ok=True)
+        names = [name for name in monster_db][:40]
+        with open(os.path.join(directory, 'data', 'bench_40.json'), 'w') as f:
+            json.dump({'characters' : [], 'enemies' : [{'name' : n, 'init_mod' : 0, 'health' : 1, 'ac' : 10, 'type' : 'x'} for n in names]}, f)
+        with open(os.path.join(directory, 'data', 'bench_1000.json'), 'w') as f:
+            json.dump({'characters' : [], 'enemies' : [{'name' : f'Zz Custom {i}', 'init_mod' : 0, 'health' : 1, 'ac' : 10, 'type' : 'x'} for i in range(1000)]}, f)
+        os.chdir(directory)
+        players = list(ct.players_list)
+        for name in ('bench_40', 'bench_1000'):
+            results[f'load_json_{name[6:]}'] = measure(lambda : ct.load_json(name, ct.Encounter(), monster_db), repeats)
+        ct.players_list[:] = players
+        os.chdir(cwd)
+
+        # Searches, spells are timed cold and repeated
+        results['search_monsters'] = measure(
+            lambda : [ct.search_monsters(q, monster_db) for q in MONSTER_QUERIES], repeats)
+        results['search_spells_cold'] = measure(
+            lambda : [ct.search_spells(q, spell_db) for q in SPELL_QUERIES], 1)
+        results['search_spells_repeat'] = measure(
+            lambda : [ct.search_spells(q, spell_db) for q in SPELL_QUERIES], repeats)
+
+        # Ranked text queries, the text index is loaded before timing
+        spell_db.load_text()
+        results['select_spell_text'] = measure(
+            lambda : [spell_db.select(q) for q in TEXT_QUERIES], repeats)
+
+        # Did you mean lookups, the name tree is loaded before timing
+        monster_db.suggest(TYPOS[0])
+        results['suggest_monsters'] = measure(
+            lambda : [monster_db.suggest(typo) for typo in TYPOS], repeats)
+    finally:
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(environ)
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return results
+
+# Compare normalized results against a baseline, returns regressed benchmarks,
+# slowdowns under min_delta seconds are treated as timer noise
+def compare(results, baseline, tolerance, min_delta):
+    regressions = []
+    scale = results['calibration'] / baseline['calibration']
+    table = [['Benchmark', 'Baseline ms', 'Current ms', 'Ratio', '']]
+    for name in sorted(results):
+        if name == 'calibration' or name not in baseline['results']:
+            continue
+        expected = baseline['results'][name] * scale
+        ratio = results[name] / expected if expected else 1
+        status = ''
+        if ratio > 1 + tolerance and results[name] - expected > min_delta:
+            status = 'SLOWER'
+            regressions.append(name)
+        table.append([name, f'{expected * 1000:.3f}', f'{results[name] * 1000:.3f}', f'{ratio:.2f}', status])
+    print(ct.tabulate.tabulate(table, headers='firstrow', tablefmt='simple'))
+    return regressions
+
+# Benchmark entrypoint
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the combat tracker hot paths')
+    parser.add_argument('--output', default='bench_output.json', help='where to write results as json')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline json to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown before failing, 0.25 is 25%%')
+    parser.add_argument('--min-delta', type=float, default=0.001, help='ignore slowdowns smaller than this many seconds')
+    parser.add_argument('--update-baseline', action='store_true', help='write results as the new baseline')
+    parser.add_argument('--quick', action='store_true', help='skip the largest catalogs and encounters')
+    parser.add_argument('--repeats', type=int, default=5, help='timed runs per benchmark, the median is kept')
+    args = parser.parse_args()
+
+    results = {'calibration' : calibrate()}
+    results.update(run(args.quick, args.repeats))
+    output = {'python' : sys.version.split(' ')[0], 'calibration' : results['calibration'], 'results' : results}
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=4)
+    print(f'results written to {args.output}')
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(output, f, indent=4)
+        print(f'baseline written to {args.baseline}')
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f'no baseline at {args.baseline}, run with --update-baseline')
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance, args.min_delta)
+    if regressions:
+        print(f'{len(regressions)} benchmark(s) slower than baseline: {", ".join(regressions)}')
+        sys.exit(1)
+    print('all benchmarks within tolerance')
+
+if __name__ == '__main__':
+    main()
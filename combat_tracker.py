@@ -1,22 +1,122 @@
 #!/usr/bin/env python3
 
-import json, os, random, csv, math
-import tabulate, itertools, sys, tty, termios
+import json, os, sys, socket
+
+# Unix socket of the resident daemon started with --daemon
+DAEMON_SOCKET = 'data/tracker.sock'
+
+# Connect to the resident daemon, raises OSError when none is running
+def connect_daemon(path=DAEMON_SOCKET):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+# Send one request to the daemon and read its reply
+def daemon_request(stream, command, draw=False, stop=False):
+    stream.write(json.dumps({'command' : command, 'draw' : draw, 'stop' : stop}) + '\n')
+    stream.flush()
+    line = stream.readline()
+    if not line:
+        raise ConnectionError('daemon closed the connection')
+    return json.loads(line)
+
+# Thin client, runs a one-shot command or the prompt against a running daemon.
+# Returns False when there is no daemon or the arguments need the full tracker
+def attach_daemon(argv):
+    if any(a.startswith('--') for a in argv) or (not argv and not sys.stdin.isatty()):
+        return False
+    try:
+        sock = connect_daemon()
+    except OSError:
+        return False
+
+    with sock:
+        stream = sock.makefile('rw')
+        try:
+            if argv: # One-shot command
+                print(daemon_request(stream, ' '.join(argv))['output'], end='')
+                return True
+
+            reply = daemon_request(stream, None, True)
+            while(True):
+                print(reply['output'], end='')
+                if reply.get('table'):
+                    print(reply['table'], end='')
+
+                try:
+                    buffer = input('~$ ')
+                except EOFError:
+                    buffer = 'exit'
+                if buffer.startswith('exit') or buffer.startswith('detach'): # State stays in the daemon
+                    print('detached...')
+                    return True
+                elif buffer.startswith('shell') or buffer.startswith('bash'): # Local subprocess
+                    command = buffer[5:].strip() if buffer.startswith('shell') else 'bash'
+                    if command:
+                        os.system(command)
+                    else:
+                        print('usage: shell <command>')
+                    reply = {'output' : ''}
+                else:
+                    reply = daemon_request(stream, buffer, True)
+        except (OSError, ValueError):
+            print('lost connection to the daemon')
+            return True
+
+# A running daemon answers before the catalogs and heavier modules load
+if __name__ == '__main__' and attach_daemon(sys.argv[1:]):
+    sys.exit(0)
+
+import random, csv, math, operator, argparse, heapq
+import tabulate, itertools, tty, termios
+import hashlib, pickle, tempfile, mmap, re, bisect, shutil, functools, time
+import cProfile, pstats, tracemalloc, threading, contextlib, io, sqlite3, asyncio, fcntl
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
+from array import array
 import traceback # Debugging traceback.print_exc()s
 
+# Cache format versions, bump when the cached structure changes
+MONSTER_CACHE_VERSION = 3
+MONSTER_FUZZY_VERSION = 1
+SPELL_INDEX_VERSION = 2
+SPELL_CARD_VERSION = 1
+SPELL_TEXT_VERSION = 1
+
+# Most rendered spell cards and result tables kept in memory
+SPELL_CARD_LIMIT = 2048
+SPELL_TABLE_LIMIT = 32
+
+# Most resolved encounter templates kept in memory
+ENCOUNTER_TEMPLATE_LIMIT = 64
+
+# Most did you mean suggestions shown for a name that was not found
+SUGGESTION_LIMIT = 3
+
+# BM25 term frequency saturation and document length normalization
+BM25_K1 = 1.2
+BM25_B = 0.75
+
 # Players list
 players_list = []
 
-# Combatant class
+# Combatant class, slotted with typed fields to keep large encounters compact
 class Combatant:
+    __slots__ = ('name', 'init_mod', 'health', 'roll', 'ac', 'type', 'locked', 'joined')
+
     def __init__(self, name, init, health, ac, e_type):
         self.name = name
-        self.init_mod = init
-        self.health = health
+        self.init_mod = int(init)
+        self.health = int(health)
         self.roll = 0
-        self.ac = ac
-        self.type = e_type
+        self.ac = parse_ac(ac)
+        self.type = sys.intern(str(e_type))
         self.locked = False
+        self.joined = 0 # Join order, set by the encounter
 
     def __str__(self):
         return f'[{self.name}, {self.init_mod}, {self.health}, {self.roll}, {self.ac}, {self.type}]'
@@ -24,6 +124,313 @@ class Combatant:
     def reroll(self):
         self.roll = random.randint(1, 20) + self.init_mod
 
+# Property reading and writing a field of a player view's record
+def _shared(field):
+    return property(operator.attrgetter('record.' + field), lambda self, value : setattr(self.record, field, value))
+
+# Player row in a further encounter, health, AC, DEX and type are read from
+# and written to the player's record so every encounter sees the same player,
+# the roll and lock stay with the row
+class PlayerView(Combatant):
+    __slots__ = ('record',)
+
+    def __init__(self, record):
+        self.record = record
+        self.name = record.name
+        self.roll = 0
+        self.locked = False
+        self.joined = 0
+
+    health = _shared('health')
+    ac = _shared('ac')
+    init_mod = _shared('init_mod')
+    type = _shared('type')
+
+# The combatant holding a player's shared fields
+def player_record(c):
+    return c.record if isinstance(c, PlayerView) else c
+
+# Split a combatant name into its base name and copy number, unsuffixed is 1
+def split_name(name):
+    parts = name.split('_')
+    if len(parts) > 1 and parts[-1].isnumeric():
+        return '_'.join(parts[:-1]), int(parts[-1])
+    return name, 1
+
+# Initiative order, highest roll first, ties to the higher DEX and then
+# to whoever joined the encounter first
+def initiative_key(c):
+    return (-c.roll, -c.init_mod, c.joined)
+
+# Encounter list that tracks the copy numbers in use for every base name
+# and indexes combatants by lowercased name for exact and prefix lookups.
+# Once sorted into initiative order the order is kept as combatants join,
+# leave or change roll, and turn points at the combatant whose turn it is
+class Encounter(list):
+    def __init__(self, combatants=()):
+        super().__init__()
+        self.suffixes = {}
+        self.by_name = {}
+        self.sorted_names = []
+        self.fuzzy = None
+        self.joins = 0
+        self.round = 0
+        self.turn = 0
+        self.ordered = False
+        self.extend(combatants)
+
+    # Combatants whose name matches exactly, ignoring case
+    def find(self, name):
+        return list(self.by_name.get(name.lower(), ()))
+
+    # Combatants whose name starts with prefix, ignoring case
+    def find_prefix(self, prefix):
+        prefix = prefix.lower()
+        matches = []
+        i = bisect.bisect_left(self.sorted_names, prefix)
+        while i < len(self.sorted_names) and self.sorted_names[i].startswith(prefix):
+            matches.extend(self.by_name[self.sorted_names[i]])
+            i = i + 1
+        return matches
+
+    # Combatants matching a name, or a prefix when it ends in *
+    def match(self, pattern):
+        if pattern.endswith('*'):
+            return self.find_prefix(pattern[:-1])
+        return self.find(pattern)
+
+    # Combatant names close to a name that was not found, the tree is built
+    # on the first miss, grows as names are added and is dropped when one leaves
+    def suggest(self, name):
+        if self.fuzzy is None:
+            self.fuzzy = BKTree()
+            for key, entries in self.by_name.items():
+                self.fuzzy.add(key, entries[0].name)
+        return self.fuzzy.suggest(name.rstrip('*'))
+
+    # Next free name for a base name, copies after the first get _2, _3, ...
+    def allocate_name(self, name):
+        base = split_name(name)[0]
+        entry = self.suffixes.get(base)
+        number = -entry[1][0] + 1 if entry else 1
+        return base if number == 1 else f'{base}_{number}'
+
+    def index(self, c):
+        key = c.name.lower()
+        if key not in self.by_name:
+            self.by_name[key] = []
+            bisect.insort(self.sorted_names, key)
+            if self.fuzzy is not None:
+                self.fuzzy.add(key, c.name)
+        self.by_name[key].append(c)
+
+    def unindex(self, c):
+        key = c.name.lower()
+        entries = self.by_name[key]
+        entries.remove(c)
+        if not entries:
+            del self.by_name[key]
+            del self.sorted_names[bisect.bisect_left(self.sorted_names, key)]
+            self.fuzzy = None
+
+    # Copy numbers in use per base name, with a max heap of them whose top is
+    # the highest, released numbers leave the heap once they reach the top
+    def register(self, name):
+        base, number = split_name(name)
+        used, high = self.suffixes.setdefault(base, [{}, []])
+        if number not in used:
+            heapq.heappush(high, -number)
+        used[number] = used.get(number, 0) + 1
+
+    def release(self, name):
+        base, number = split_name(name)
+        used, high = self.suffixes[base]
+        used[number] = used[number] - 1
+        if used[number] == 0:
+            del used[number]
+
+        while high and -high[0] not in used:
+            heapq.heappop(high)
+        if not used:
+            del self.suffixes[base]
+
+    # Position of c, found by bisecting its key when in initiative order
+    def position(self, c):
+        if not self.ordered:
+            return list.index(self, c)
+        key = initiative_key(c)
+        i = bisect.bisect_left(self, key, key=initiative_key)
+        while i < len(self) and initiative_key(self[i]) == key:
+            if self[i] is c:
+                return i
+            i = i + 1
+        return list.index(self, c)
+
+    # Insert keeping initiative order, after any combatant with the same key
+    def place(self, c):
+        if not self.ordered:
+            super().append(c)
+            return
+        i = bisect.bisect_right(self, initiative_key(c), key=initiative_key)
+        super().insert(i, c)
+        if i <= self.turn and len(self) > 1:
+            self.turn = self.turn + 1
+
+    def take(self, i):
+        c = super().pop(i)
+        if i < self.turn:
+            self.turn = self.turn - 1
+        elif self.turn >= len(self):
+            self.turn = 0
+        return c
+
+    # A combatant leaves, when it had the last turn of the round the next
+    # round is rolled as next does at the end of a round
+    def leave(self, i):
+        last = self.ordered and i == self.turn == len(self) - 1 and len(self) > 1
+        c = self.take(i)
+        self.release(c.name)
+        self.unindex(c)
+        if last:
+            advance_round(self)
+        return c
+
+    # Count, number and index a combatant joining the encounter
+    def admit(self, c):
+        c.joined = self.joins
+        self.joins = self.joins + 1
+        self.register(c.name)
+        self.index(c)
+
+    def append(self, c):
+        self.admit(c)
+        self.place(c)
+
+    def extend(self, combatants):
+        for c in combatants:
+            self.append(c)
+
+    def __iadd__(self, combatants):
+        self.extend(combatants)
+        return self
+
+    def __imul__(self, n):
+        raise TypeError('combatants cannot be repeated, add copies instead')
+
+    # The position is only kept in a manual order, in initiative order the
+    # combatant is placed by its key
+    def insert(self, i, c):
+        self.admit(c)
+        if self.ordered:
+            self.place(c)
+        else:
+            super().insert(i, c)
+
+    # Replace the combatant at i, in initiative order the new one is placed
+    # by its key and keeps the turn if the old one had it
+    def __setitem__(self, i, c):
+        if isinstance(i, slice):
+            raise TypeError('slice assignment is not supported, use add and remove')
+        i = range(len(self))[i]
+        old = self[i]
+        self.release(old.name)
+        self.unindex(old)
+        self.admit(c)
+        if not self.ordered:
+            super().__setitem__(i, c)
+            return
+        current = i == self.turn
+        self.take(i)
+        self.place(c)
+        if current:
+            self.turn = self.position(c)
+
+    def __delitem__(self, i):
+        if isinstance(i, slice):
+            for c in self[i]:
+                self.remove(c)
+        else:
+            self.pop(i)
+
+    def remove(self, c):
+        self.leave(self.position(c))
+
+    def pop(self, i=-1):
+        return self.leave(range(len(self))[i])
+
+    def clear(self):
+        super().clear()
+        self.suffixes.clear()
+        self.by_name.clear()
+        self.sorted_names.clear()
+        self.fuzzy = None
+        self.joins = 0
+        self.round = 0
+        self.turn = 0
+        self.ordered = False
+
+    # Any other sort is a manual order, initiative is no longer kept
+    def sort(self, *, key=None, reverse=False):
+        super().sort(key=key, reverse=reverse)
+        self.ordered = False
+        self.turn = 0
+
+    def reverse(self):
+        super().reverse()
+        self.ordered = False
+        self.turn = 0
+
+    # Bulk sort into initiative order, the first combatant has the turn
+    def sort_initiative(self):
+        super().sort(key=initiative_key)
+        self.ordered = True
+        self.turn = 0
+
+    # Change a field that orders initiative and move only that combatant
+    def update(self, c, field, value):
+        if not self.ordered: # Manual order stays as it is
+            setattr(c, field, value)
+            return
+        i = self.position(c)
+        current = i == self.turn
+        self.take(i)
+        setattr(c, field, value)
+        self.place(c)
+        if current: # The turn follows the combatant
+            self.turn = self.position(c)
+
+    # Turn to mark in tables, None outside initiative order
+    def marked_turn(self):
+        return self.turn if self.ordered and self else None
+
+    # Move the turn forward, False when the round is over
+    def next_turn(self):
+        if self.turn + 1 >= len(self):
+            return False
+        self.turn = self.turn + 1
+        return True
+
+    def previous_turn(self):
+        if self.turn == 0:
+            return False
+        self.turn = self.turn - 1
+        return True
+
+    def rename(self, c, name):
+        self.release(c.name)
+        self.unindex(c)
+        c.name = name
+        self.register(name)
+        self.index(c)
+
+# Armor class as an int, catalog and saved values may be strings
+def parse_ac(ac):
+    try:
+        return int(ac)
+    except (TypeError, ValueError):
+        return 0
+
+
 # _Getkey class
 class _Getkey:
     def __call__(self):
@@ -56,106 +463,494 @@ def get_key():
     elif k == '\x1b[D':
         return 'exit'
 
-# General add function
+# General add function, numbers copies of the same name
 def add_combatant(c, combatants):
-    c_num = -1
-
-    name = c.name.split('_')
-    if name[-1].isnumeric():
-        del name[-1]
-        c.name = '_'.join(name)
-
-    # Iterate through combatants to find match
-    for i in combatants:
-        if i.name.startswith(c.name):
-            start = 0
-
-            # Find start of final number
-            for d in range(len(i.name)):
-                if not i.name[d].isdigit():
-                    start = d
-
-            # Calculate number
-            if start != len(i.name) - 1:
-                num = int(i.name[start + 1:]) + 1
-                if num > c_num:
-                    c_num = num
-            else:
-                c_num = 2
-
-    # Only include num if name non-unique
-    if c_num > -1:
-        c.name = c.name + f'_{c_num}'
-
-    # Append to combatants list
+    c.name = combatants.allocate_name(c.name)
     combatants.append(c)
 
-# Load encounter from json
+# Encounter json from the library, or from data/<file>.json when it is not
+# there, reserved names like the autosave are always read from their file
+def read_encounter(file):
+    file_json = None if reserved_encounter(file) else library.get(file)
+    if file_json is None:
+        with open(os.getcwd() + f'/data/{file}.json') as file_handle:
+            file_json = json.load(file_handle)
+    return file_json
+
+# Cache key and size and modification stamp of the library entry or file
+# read_encounter would read, library entries share the stamp of the library file
+def encounter_source(file):
+    if not reserved_encounter(file) and library.contains(file):
+        key, path = (library.path, file.lower()), library.path
+    else:
+        path = os.getcwd() + f'/data/{file}.json'
+        key = (path,)
+    stat = os.stat(path)
+    return key, (stat.st_size, stat.st_mtime_ns)
+
+# Resolve every row of an encounter against the db once, rows keep the order
+# load_json adds them in and catalog rows keep the roll to draw HP from
+def compile_encounter(file_json, db):
+    entries = []
+    for c, e in itertools.zip_longest(file_json['characters'], file_json['enemies']):
+        if c:
+            entries.append((True, c))
+        if e:
+            entries.append((False, e))
+
+    # Each distinct name is looked up once
+    resolved = {}
+    for is_character, entry in entries:
+        if entry['name'] not in resolved:
+            resolved[entry['name']] = db.find(entry['name'])
+
+    template = []
+    for is_character, entry in entries:
+        matches = resolved[entry['name']]
+        if matches: # From DB
+            name = matches[0]
+            template.append((is_character, entry['name'], f'database has: {", ".join(matches[:3])}...',
+                name, db[name]['dex_mod'], db[name]['roll'], 0, db[name]['ac'], db[name]['type']))
+        else: # From fields
+            template.append((is_character, entry['name'], None,
+                entry['name'], entry['init_mod'], None, entry['health'], entry['ac'], entry['type']))
+    return template
+
+# Load encounter from the library or json
 def load_json(file, combatants, db):
     # Default behavior
     try:
-        # Get file handle and read in
-        file_handle = open(os.getcwd() + f'/data/{file}.json')
-        file_json = json.load(file_handle)
-        file_handle.close()
+        # Resolved rows are reused until the file or library changes
+        key, stamp = encounter_source(file)
+        cached = db.templates.get(key)
+        if cached and cached[0] == stamp:
+            template = cached[1]
+        else:
+            template = compile_encounter(read_encounter(file), db)
+            db.templates.put(key, (stamp, template))
+
+        # Roll HP for every catalog row at once, one batch per expression
+        counts = {}
+        for row in template:
+            if row[5] is not None:
+                counts[row[5]] = counts.get(row[5], 0) + 1
+        rolls = {roll : iter(roll_batch(roll, n)) for roll, n in counts.items()}
+
+        for is_character, file_name, found, name, dex_mod, roll, health, ac, e_type in template:
+            if is_character and file_name not in players_list:
+                players_list.append(file_name)
+
+            if found: # From DB with a fresh HP roll
+                health = next(rolls[roll])
+                print(found)
+            add_combatant(Combatant(name, dex_mod, health, ac, e_type), combatants)
+            print(f'added {name} : {dex_mod} DEX, {health} HP, {ac} AC, {e_type}')
+        players_list.sort()
+
+        print(f'{file} loaded successfully')
+    except KeyError: # Key exception
+        print(f'{file} formatted incorrectly')
+        raise KeyError(f'{file} is missing a key')
+    except: # Other exception
+        raise Exception(f'opening {file} raised an exception')
+
+# Hash the contents of a data file
+def hash_file(file):
+    with open(file, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+# Fingerprint a data file by size, mtime and content hash
+def fingerprint(file):
+    stat = os.stat(file)
+    return {
+        'size' : stat.st_size,
+        'mtime' : stat.st_mtime_ns,
+        'hash' : hash_file(file)
+    }
 
-        # Try import characters and enemies in parallel
-        for c, e in itertools.zip_longest(file_json['characters'], file_json['enemies']):
-            if c and c['name'] not in players_list:
-                players_list.append(c['name'])
-
-            players_list.sort()
-            c_matches = []
-            e_matches = []
-
-            # Find all matches in db
-            for name in db:
-                if c and name.lower().find(c['name'].lower()) != -1:
-                    c_matches.append(name)
-                if e and name.lower().find(e['name'].lower()) != -1:
-                    e_matches.append(name)
-
-            # Sort matches by length
-            c_matches.sort(key=len)
-            e_matches.sort(key=len)
-            
-            if c_matches: # Add from DB
-                name = c_matches[0]
-                health = parse_roll(db[name]['roll'])
-                dex_mod = db[name]['dex_mod']
-                ac = db[name]['ac']
-                e_type = db[name]['type']
+# Load cached data built from source, None if missing or stale
+def load_cache(cache_file, source, version):
+    try:
+        with open(cache_file, 'rb') as f:
+            cache = pickle.loads(f.read())
+
+        if cache['version'] != version:
+            return None
+
+        # Size and mtime are enough unless the file was touched
+        key = cache['key']
+        stat = os.stat(source)
+        if key['size'] != stat.st_size:
+            return None
+        if key['mtime'] != stat.st_mtime_ns and key['hash'] != hash_file(source):
+            return None
+        return cache['data']
+    except:
+        return None
 
-                print(f'database has: {", ".join(c_matches[:3])}...')
-                add_combatant(Combatant(name, dex_mod, health, ac, e_type), combatants)
-                print(f'added {name} : {dex_mod} DEX, {health} HP, {ac} AC, {e_type}')
-            elif c: # Add from fields
-                add_combatant(Combatant(c['name'], c['init_mod'], c['health'], c['ac'], c['type']), combatants)
-                print(f"added {c['name']} : {c['init_mod']} DEX, {c['health']} HP, {c['ac']} AC, {c['type']}")
+# Write bytes to a temp file beside path and rename it over path, readers
+# see the old or the new file but never a partial one
+def write_atomic(path, data, sync=False):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
 
-            if e_matches: # Add from DB
-                name = e_matches[0]
-                health = parse_roll(db[name]['roll'])
-                dex_mod = db[name]['dex_mod']
-                ac = db[name]['ac']
-                e_type = db[name]['type']
+# Atomically write cached data built from source
+def write_cache(cache_file, key, version, data):
+    try:
+        cache = {'version' : version, 'key' : key, 'data' : data}
+        write_atomic(cache_file, pickle.dumps(cache, pickle.HIGHEST_PROTOCOL))
+    except: # Cache is optional, next launch reparses
+        pass
+
+# Substring index over names, built from the 1, 2 and 3-grams of each name
+class NameIndex:
+    def __init__(self, names):
+        # Ids are assigned shortest name first, the order lookups are ranked by
+        names = list(names)
+        order = sorted(range(len(names)), key=lambda i : len(names[i]))
+        self.names = [names[i] for i in order]
+        self.lowered = [name.lower() for name in self.names]
+        self.positions = order
+        self.grams = {}
+
+        for i, name in enumerate(self.lowered):
+            grams = set()
+            for n in range(1, 4):
+                for j in range(len(name) - n + 1):
+                    grams.add(name[j:j + n])
+            for gram in grams:
+                self.grams.setdefault(gram, []).append(i)
+
+    # Find names containing query, shortest first or in insertion order
+    def find(self, query, ranked=True):
+        query = query.lower()
+        if query == '':
+            ids = range(len(self.names))
+        elif len(query) <= 3: # Query is a gram, its posting list is exact
+            ids = self.grams.get(query, [])
+        else: # Intersect trigram postings smallest first, then verify
+            postings = [self.grams.get(query[j:j + 3], []) for j in range(len(query) - 2)]
+            postings.sort(key=len)
+            candidates = set(postings[0])
+            for posting in postings[1:]:
+                if not candidates:
+                    break
+                candidates.intersection_update(posting)
+            ids = [i for i in sorted(candidates) if query in self.lowered[i]]
+
+        if not ranked:
+            ids = sorted(ids, key=lambda i : self.positions[i])
+        return [self.names[i] for i in ids]
+
+# Edit distance between two strings, bit-parallel over the characters of a
+# so each character of b costs a few integer operations instead of a row
+def levenshtein(a, b):
+    if not a or not b:
+        return len(a) + len(b)
+    masks = {}
+    for i, c in enumerate(a):
+        masks[c] = masks.get(c, 0) | 1 << i
+    full = (1 << len(a)) - 1
+    last = 1 << (len(a) - 1)
+    positive, negative, distance = full, 0, len(a)
+    for c in b:
+        match = masks.get(c, 0)
+        vertical = match | negative
+        horizontal = (((match & positive) + positive) ^ positive) | match
+        up = negative | ~(horizontal | positive)
+        down = positive & horizontal
+        if up & last:
+            distance = distance + 1
+        elif down & last:
+            distance = distance - 1
+        up = (up << 1) | 1
+        down = down << 1
+        positive = (down | ~(vertical | up)) & full
+        negative = up & vertical & full
+    return distance
+
+# Largest edit distance suggested for a query, short names allow one typo
+def suggestion_distance(query):
+    return 1 if len(query) <= 4 else 2
+
+# BK-tree over lowercased keys, children are keyed by their edit distance to
+# the parent so a search only descends into distances that can still match
+class BKTree:
+    def __init__(self):
+        self.root = None
+
+    # Add a key and the name it stands for, repeated keys keep the first name
+    def add(self, key, name):
+        if self.root is None:
+            self.root = (key, name, {})
+            return
+        node = self.root
+        while True:
+            distance = levenshtein(key, node[0])
+            if distance == 0:
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (key, name, {})
+                return
+            node = child
+
+    # (distance, name) of every key within limit of query, closest first
+    def search(self, query, limit):
+        query = query.lower()
+        found = []
+        stack = [self.root] if self.root else []
+        while stack:
+            key, name, children = stack.pop()
+            distance = levenshtein(query, key)
+            if distance <= limit:
+                found.append((distance, name))
+            for child_distance, child in children.items():
+                if distance - limit <= child_distance <= distance + limit:
+                    stack.append(child)
+        found.sort()
+        return found
+
+    # Names a mistyped query most likely meant, only the closest are kept
+    def suggest(self, query, count=SUGGESTION_LIMIT):
+        found = self.search(query, suggestion_distance(query))
+        return [name for distance, name in found[:count] if distance == found[0][0]]
+
+# Sentinel for missing values in integer columns
+MISSING = -1
+
+# Monster database columns, text columns keep the strings the tracker displays
+TEXT_COLUMNS = ('size', 'type', 'subtype', 'alignment', 'armor_class', 'hit_points', 'roll', 'ac', 'cr')
+INT_COLUMNS = ('ac_value', 'hp', 'str', 'dex', 'con', 'int', 'wis', 'cha', 'pb', 'dex_mod')
+FLOAT_COLUMNS = ('cr_value',)
+
+# Query fields and the columns they are answered from
+NUMERIC_FIELDS = {
+    'cr' : 'cr_value', 'ac' : 'ac_value', 'hp' : 'hp', 'pb' : 'pb',
+    'str' : 'str', 'dex' : 'dex', 'con' : 'con', 'int' : 'int', 'wis' : 'wis', 'cha' : 'cha'
+}
+CATEGORY_FIELDS = ('size', 'type', 'subtype', 'alignment')
+
+# Parse a challenge rating, accepting fractions like 1/2
+def parse_cr(text):
+    if '/' in text:
+        num, den = text.split('/')
+        return int(num) / int(den)
+    return float(text)
+
+# Parse an integer column value, MISSING if blank or malformed
+def parse_int(text):
+    text = text.strip().split(' ')[0]
+    return int(text) if text.isdigit() else MISSING
+
+# Parse a numeric condition (5, 2..5, ..5, 2.., >=15, <3) into bounds
+def parse_condition(text):
+    for op in ('>=', '<=', '>', '<'):
+        if text.startswith(op):
+            value = parse_cr(text[len(op):])
+            if op[0] == '>':
+                return value, op == '>=', math.inf, True
+            return -math.inf, True, value, op == '<='
+    if '..' in text:
+        low, high = text.split('..')
+        low = parse_cr(low) if low else -math.inf
+        high = parse_cr(high) if high else math.inf
+        return low, True, high, True
+    value = parse_cr(text)
+    return value, True, value, True
+
+# Index keys of a category value, sizes like "M or S" index under each size
+def category_keys(field, value):
+    value = value.strip().lower()
+    if field == 'size':
+        return set(re.findall(r'\b[tsmlhg]\b', value))
+    return {value} if value else set()
+
+# Array-backed monster database with typed columns for every csv field,
+# sorted per-column indexes for range queries and a name index
+class MonsterDB:
+    def __init__(self):
+        self.names = []
+        self.ids = {}
+        self.columns = {}
+        for column in TEXT_COLUMNS:
+            self.columns[column] = []
+        for column in INT_COLUMNS:
+            self.columns[column] = array('h')
+        for column in FLOAT_COLUMNS:
+            self.columns[column] = array('d')
+        self.name_index = None
+        self.fuzzy_index = None
+        self.fuzzy_source = None
+        self.sorted_index = None
+        self.category_index = None
+        self.templates = LRUCache(ENCOUNTER_TEMPLATE_LIMIT) # Encounter rows resolved against this db, see load_json
+
+    def __getitem__(self, name):
+        i = self.ids[name]
+        entry = {}
+        for column in self.columns:
+            entry[column] = self.columns[column][i]
+        return entry
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    # Resolved encounters are not part of the cached catalog
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('templates', None)
+        return state
+
+    # Copy the state of another database, used when loading the cache
+    def restore(self, other):
+        self.__dict__.update(other.__dict__)
+        self.templates = LRUCache(ENCOUNTER_TEMPLATE_LIMIT)
+
+    # Add or replace a monster from its parsed column values
+    def add(self, name, values):
+        if name in self.ids: # Later rows replace earlier ones in place
+            i = self.ids[name]
+            for column in self.columns:
+                self.columns[column][i] = values[column]
+        else:
+            self.ids[name] = len(self.names)
+            self.names.append(name)
+            for column in self.columns:
+                self.columns[column].append(values[column])
+
+        self.name_index = None
+        self.fuzzy_index = None
+        self.fuzzy_source = None
+        self.sorted_index = None
+        self.category_index = None
+        self.templates.clear()
+
+    # Build the name, sorted numeric and category indexes
+    def build_indexes(self):
+        if self.name_index is None:
+            self.name_index = NameIndex(self.names)
+
+        if self.sorted_index is None:
+            self.sorted_index = {}
+            for column in NUMERIC_FIELDS.values():
+                values = self.columns[column]
+                ids = [i for i in range(len(values)) if values[i] == values[i] and values[i] != MISSING]
+                ids.sort(key=lambda i : values[i])
+                typecode = values.typecode
+                self.sorted_index[column] = (array(typecode, [values[i] for i in ids]), array('i', ids))
+
+        if self.category_index is None:
+            self.category_index = {}
+            for field in CATEGORY_FIELDS:
+                index = {}
+                for i, value in enumerate(self.columns[field]):
+                    for key in category_keys(field, value):
+                        index.setdefault(key, array('i')).append(i)
+                self.category_index[field] = index
+
+    # Find monster names containing query, shortest first
+    def find(self, query, ranked=True):
+        self.build_indexes()
+        return self.name_index.find(query, ranked)
+
+    # Monster names close to a mistyped query
+    def suggest(self, query):
+        if self.fuzzy_index is None:
+            self.load_fuzzy_index()
+        return self.fuzzy_index.suggest(query)
+
+    # Load the name tree saved next to the catalog, building and saving it
+    # when missing or stale, it is only needed once a name is mistyped
+    def load_fuzzy_index(self):
+        fuzzy_file = self.fuzzy_source + '.fuzzy' if self.fuzzy_source else None
+        if fuzzy_file:
+            self.fuzzy_index = load_cache(fuzzy_file, self.fuzzy_source, MONSTER_FUZZY_VERSION)
+        if self.fuzzy_index is None:
+            key = fingerprint(self.fuzzy_source) if fuzzy_file else None
+            self.fuzzy_index = BKTree()
+            for name in self.names:
+                self.fuzzy_index.add(name.lower(), name)
+            if fuzzy_file:
+                write_cache(fuzzy_file, key, MONSTER_FUZZY_VERSION, self.fuzzy_index)
+
+    # Ids of monsters with a numeric field inside the condition
+    def range_ids(self, field, condition):
+        self.build_indexes()
+        low, low_inclusive, high, high_inclusive = parse_condition(condition)
+        values, ids = self.sorted_index[NUMERIC_FIELDS[field]]
+        start = bisect.bisect_left(values, low) if low_inclusive else bisect.bisect_right(values, low)
+        end = bisect.bisect_right(values, high) if high_inclusive else bisect.bisect_left(values, high)
+        return ids[start:end]
+
+    # Ids of monsters whose category field is any of the comma separated values
+    def category_ids(self, field, values):
+        self.build_indexes()
+        ids = set()
+        for value in values.split(','):
+            for key in category_keys(field, value):
+                ids.update(self.category_index[field].get(key, ()))
+        return ids
+
+    # Ids matching every (field, value) filter, intersected smallest first
+    def query(self, filters):
+        results = []
+        for field, value in filters:
+            if field == 'name':
+                results.append([self.ids[name] for name in self.find(value, False)])
+            elif field in NUMERIC_FIELDS:
+                results.append(self.range_ids(field, value))
+            elif field in CATEGORY_FIELDS:
+                results.append(self.category_ids(field, value))
+            else:
+                raise KeyError(f'unknown field {field}')
 
-                print(f'database has: {", ".join(e_matches[:3])}...')
-                add_combatant(Combatant(name, dex_mod, health, ac, e_type), combatants)
-                print(f'added {name} : {dex_mod} DEX, {health} HP, {ac} AC, {e_type}')
-            elif e: # Add from fields
-                add_combatant(Combatant(e['name'], e['init_mod'], e['health'], e['ac'], e['type']), combatants)
-                print(f"added {e['name']} : {e['init_mod']} DEX, {e['health']} HP, {e['ac']} AC, {e['type']}")
+        results.sort(key=len)
+        matches = set(results[0])
+        for result in results[1:]:
+            if not matches:
+                break
+            matches.intersection_update(result)
 
-        print(f'{file}.json loaded successfully')
-    except KeyError: # Key exception
-        print(f'{file}.json formatted incorrectly')
-        raise KeyError(f'{file}.json is missing a key')
-    except: # Other exception
-        raise Exception(f'opening {file}.json raised an exception')
+        # Order by CR, then catalog order
+        cr = self.columns['cr_value']
+        return sorted(matches, key=lambda i : (cr[i], i))
 
-# Load monster database from csv
+# Load monster database from csv, using the parsed cache when current
 def populate_monsters(file, db):
+    cache_file = file + '.cache'
+    cached = load_cache(cache_file, file, MONSTER_CACHE_VERSION)
+    if cached is not None:
+        db.restore(cached)
+    else:
+        # Fingerprint before parsing so a concurrent edit invalidates the cache
+        key = fingerprint(file)
+        if parse_monsters(file, db) == 0:
+            db.build_indexes() # Indexes are cached prebuilt
+            write_cache(cache_file, key, MONSTER_CACHE_VERSION, db)
+    db.fuzzy_source = file # Name tree is saved beside the catalog it was built from
+
+# Parse monster database from csv, returns number of rows that failed
+def parse_monsters(file, db):
+    errors = 0
+
     # Open up file and read fields
     with open(file, newline='') as f:
         reader = csv.reader(f, delimiter=',', quotechar='"')
@@ -181,49 +976,489 @@ def populate_monsters(file, db):
                 e_type = monster[2]
 
                 cr = monster[13]
+                try:
+                    cr_value = parse_cr(cr)
+                except ValueError:
+                    cr_value = math.nan
 
                 # Populate DB entry
-                db[monster[0]] = {
+                db.add(monster[0], {
+                    'size' : sys.intern(monster[1].strip()),
+                    'type' : sys.intern(e_type),
+                    'subtype' : sys.intern(monster[3].strip()),
+                    'alignment' : sys.intern(monster[4]),
+                    'armor_class' : monster[5],
+                    'hit_points' : monster[6],
                     'roll' : health_roll,
-                    'dex_mod' : dex_mod,
                     'ac' : ac,
-                    'type' : e_type,
-                    'cr' : cr
-                }
+                    'cr' : sys.intern(cr),
+                    'ac_value' : parse_int(ac),
+                    'hp' : parse_int(monster[6]),
+                    'str' : parse_int(monster[7]),
+                    'dex' : parse_int(monster[8]),
+                    'con' : parse_int(monster[9]),
+                    'int' : parse_int(monster[10]),
+                    'wis' : parse_int(monster[11]),
+                    'cha' : parse_int(monster[12]),
+                    'pb' : parse_int(monster[14]),
+                    'dex_mod' : dex_mod,
+                    'cr_value' : cr_value
+                })
             except: # Throw exception
                 print(f'[ERROR] can\'t load in {monster[0]}')
                 input('<enter> to continue')
+                errors = errors + 1
+    return errors
+
+# Least recently used cache with a bounded number of entries
+class LRUCache:
+    def __init__(self, limit):
+        self.limit = limit
+        self.entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        if key not in self.entries:
+            return default
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.limit:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+# Spell database that keeps only a small index resident and reads
+# full records on demand from memory-mapped spell files
+class SpellStore:
+    def __init__(self):
+        self.files = []
+        self.maps = []
+        self.index = {}
+        self.entries = []
+        self.bitmaps = None
+        self.postings = None
+        self.cards = LRUCache(SPELL_CARD_LIMIT)
+        self.tables = LRUCache(SPELL_TABLE_LIMIT)
+        self.cards_loaded = False
+        self.cards_dirty = False
+
+    def __getitem__(self, name):
+        entry = self.index[name]
+        data = self.maps[entry['file']]
+        return json.loads(data[entry['offset']:entry['offset'] + entry['length']].decode('utf-8'))
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    # Add a spell file, later files override spells with the same name
+    def add_file(self, file):
+        index_file = file + '.index'
+        entries = load_cache(index_file, file, SPELL_INDEX_VERSION)
+        if entries is None:
+            key = fingerprint(file)
+            entries = index_spell_file(file)
+            write_cache(index_file, key, SPELL_INDEX_VERSION, entries)
+
+        with open(file, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        file_id = len(self.maps)
+        self.files.append(file)
+        self.maps.append(data)
+        self.entries.append(entries)
+        for entry in entries:
+            self.index[entry['name']] = dict(entry, file=file_id)
+        self.bitmaps = None
+        self.postings = None
+        self.cards.clear()
+        self.tables.clear()
+        self.cards_loaded = False
+
+    # Rendered table cells of a spell, cached per spell and terminal width
+    def card(self, name, width):
+        if not self.cards_loaded:
+            self.load_cards()
+
+        key = (name, width)
+        card = self.cards.get(key)
+        if card is None:
+            card = render_spell_card(self[name], min(71, max(30, width - 40)))
+            self.cards.put(key, card)
+            self.cards_dirty = True
+        return card
+
+    # Rendered result table for a list of spells, cached per result and width
+    def table(self, names, width):
+        key = (tuple(names), width)
+        table = self.tables.get(key)
+        if table is None:
+            rows = [['Attributes', 'Description']]
+            for name in names:
+                rows.append(self.card(name, width))
+            table = tabulate.tabulate(
+                rows,
+                headers='firstrow',
+                tablefmt='fancy_grid',
+                stralign='left'
+            )
+            self.tables.put(key, table)
+        return table
 
+    # Load rendered cards saved next to the first spell file, if still current
+    def load_cards(self):
+        self.cards_loaded = True
+        try:
+            with open(self.files[0] + '.cards', 'rb') as f:
+                cache = pickle.loads(f.read())
+            if cache['version'] == SPELL_CARD_VERSION and cache['key'] == [fingerprint(file) for file in self.files]:
+                for key, card in cache['data']:
+                    self.cards.put(key, card)
+        except:
+            pass # Cards are rendered again on demand
+
+    # Save rendered cards next to the first spell file
+    def save_cards(self):
+        if self.files and self.cards_dirty:
+            key = [fingerprint(file) for file in self.files]
+            write_cache(self.files[0] + '.cards', key, SPELL_CARD_VERSION, list(self.cards.entries.items()))
+            self.cards_dirty = False
+
+    # Build a bitset per class, level, school, component and the ritual flag,
+    # bit i stands for the i-th spell in index order
+    def build_bitmaps(self):
+        self.order = list(self.index)
+        self.positions = {name : i for i, name in enumerate(self.order)}
+        self.name_index = NameIndex(self.order)
+        self.fuzzy_index = BKTree()
+        for name in self.order:
+            self.fuzzy_index.add(name.lower(), name)
+        self.universe = (1 << len(self.order)) - 1
+
+        facets = {'class' : {}, 'level' : {}, 'school' : {}, 'component' : {}, 'ritual' : {}}
+        for i, name in enumerate(self.order):
+            entry = self.index[name]
+            for player_class in entry['classes']:
+                facets['class'].setdefault(player_class.lower(), []).append(i)
+            facets['level'].setdefault(entry['level'].lower(), []).append(i)
+            facets['school'].setdefault(entry['school'].lower(), []).append(i)
+            for component in entry['components']:
+                facets['component'].setdefault(component.lower(), []).append(i)
+            if entry['ritual']:
+                facets['ritual'].setdefault('yes', []).append(i)
+
+        self.bitmaps = {}
+        for facet in facets:
+            self.bitmaps[facet] = {}
+            for value, positions in facets[facet].items():
+                self.bitmaps[facet][value] = bitset(positions, len(self.order))
+
+    # Union of the bitsets of a facet whose values contain text
+    def facet_bits(self, facet, text):
+        bits = 0
+        for value, value_bits in self.bitmaps[facet].items():
+            if text in value:
+                bits = bits | value_bits
+        return bits
+
+    # Bitset of spells matching a single filter
+    def filter_bits(self, field, value=None):
+        if field == 'all':
+            return self.universe
+        elif field == 'ritual':
+            return self.bitmaps['ritual'].get('yes', 0)
+        elif field in ('verbal', 'somatic', 'material'):
+            return self.bitmaps['component'].get(field[0], 0)
+        elif field == 'name':
+            names = self.name_index.find(value.replace('_', ' '))
+            return bitset([self.positions[name] for name in names], len(self.order))
+        elif field == 'level':
+            return self.bitmaps['level'].get('cantrip' if value == '0' else value.lower(), 0)
+        elif field == 'component':
+            bits = self.universe
+            for component in value.lower().replace(',', ''):
+                bits = bits & self.bitmaps['component'].get(component, 0)
+            return bits
+        elif field in ('class', 'school'):
+            return self.facet_bits(field, value.lower())
+        raise KeyError(f'unknown filter {field}')
+
+    # Load the text index of every spell file, building and saving it beside
+    # the file when missing or stale, postings are merged by spell position
+    def load_text(self):
+        if self.bitmaps is None:
+            self.build_bitmaps()
+
+        self.postings = {}
+        self.lengths = [0] * len(self.order)
+        for file_id, file in enumerate(self.files):
+            text_file = file + '.text'
+            text = load_cache(text_file, file, SPELL_TEXT_VERSION)
+            if text is None:
+                key = fingerprint(file)
+                text = index_spell_text(file, self.entries[file_id])
+                write_cache(text_file, key, SPELL_TEXT_VERSION, text)
+
+            # Positions of the entries still in the store, later files override
+            positions = []
+            for entry in self.entries[file_id]:
+                current = self.index[entry['name']]
+                owned = current['file'] == file_id and current['offset'] == entry['offset']
+                positions.append(self.positions[entry['name']] if owned else None)
+
+            for i, length in enumerate(text['lengths']):
+                if positions[i] is not None:
+                    self.lengths[positions[i]] = length
+            for term, posting in text['postings'].items():
+                merged = self.postings.setdefault(term, [])
+                for i, count in posting:
+                    if positions[i] is not None:
+                        merged.append((positions[i], count))
+        self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 1
+
+    # Bitset of spells whose text has every word and their BM25 scores
+    def text_bits(self, words):
+        if self.postings is None:
+            self.load_text()
+
+        terms = tokenize(' '.join(words))
+        if not terms:
+            return 0, {}
+        count = len(self.order)
+        scores = None
+        for term in dict.fromkeys(terms):
+            posting = self.postings.get(term, [])
+            idf = math.log(1 + (count - len(posting) + 0.5) / (len(posting) + 0.5))
+            term_scores = {}
+            for position, frequency in posting:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[position] / self.average_length)
+                term_scores[position] = idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {p : score + term_scores[p] for p, score in scores.items() if p in term_scores}
+        return bitset(scores, count), scores
+
+    # Evaluate filter terms, terms are and-ed, "not" negates the next term
+    # and "or" separates alternatives, text takes every word up to the next
+    # filter, returns the bitset, any facet listings and text scores by position
+    def select(self, terms):
+        if self.bitmaps is None:
+            self.build_bitmaps()
+
+        result = 0
+        group = None
+        facets = []
+        scores = None
+        negate = False
+        i = 0
+        while i < len(terms):
+            term = terms[i].lower()
+            if negate and term in ('or', 'classes', 'schools'):
+                raise IndexError('not needs a filter')
+            if term == 'or':
+                result = result | (self.universe if group is None else group)
+                group = None
+            elif term == 'not':
+                negate = not negate
+            elif term in ('classes', 'schools'):
+                facets.append(term[:-2] if term == 'classes' else term[:-1])
+            else:
+                if term == 'text':
+                    end = i + 1
+                    while end < len(terms) and terms[end].lower() not in SPELL_FILTER_WORDS:
+                        end = end + 1
+                    if end == i + 1:
+                        raise IndexError('text needs words')
+                    bits, text_scores = self.text_bits(terms[i + 1:end])
+                    if not negate: # Negated text matches carry no relevance
+                        scores = {} if scores is None else scores
+                        for position, score in text_scores.items():
+                            scores[position] = scores.get(position, 0) + score
+                    i = end - 1
+                elif term in ('class', 'level', 'name', 'school', 'component'):
+                    bits = self.filter_bits(term, terms[i + 1])
+                    i = i + 1
+                else:
+                    bits = self.filter_bits(term)
+                if negate:
+                    bits = self.universe & ~bits
+                    negate = False
+                group = bits if group is None else group & bits
+            i = i + 1
+
+        if negate:
+            raise IndexError('not needs a filter')
+        result = result | (self.universe if group is None else group)
+        return result, facets, scores
+
+    # Spell names close to a mistyped query
+    def suggest(self, query):
+        if self.bitmaps is None:
+            self.build_bitmaps()
+        return self.fuzzy_index.suggest(query.replace('_', ' '))
+
+    # Count spells in bits for every value of a facet
+    def facet_counts(self, facet, bits):
+        counts = {}
+        for value, value_bits in self.bitmaps[facet].items():
+            count = (value_bits & bits).bit_count()
+            if count:
+                counts[value] = count
+        return counts
+
+    # Names of the spells in a bitset, in index order
+    def names(self, bits):
+        names = []
+        while bits:
+            low = bits & -bits
+            names.append(self.order[low.bit_length() - 1])
+            bits = bits ^ low
+        return names
+
+# Words that end a text filter's words
+SPELL_FILTER_WORDS = (
+    'or', 'not', 'text', 'class', 'level', 'name', 'school', 'component', 'ritual', 'all',
+    'verbal', 'somatic', 'material', 'classes', 'schools'
+)
+
+# Words left out of the spell text index
+STOP_WORDS = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'can', 'for', 'from', 'has', 'have', 'if',
+    'in', 'into', 'is', 'it', 'its', 'of', 'on', 'or', 'that', 'the', 'their', 'them', 'this',
+    'to', 'which', 'who', 'with', 'you', 'your'
+))
+
+# Suffixes the stemmer removes, the first that leaves three letters wins
+STEM_SUFFIXES = ('ingly', 'edly', 'ing', 'ed', 'ly', 'es', 's', 'e')
+
+# Light suffix stemmer, damage, damaged and damages share a stem
+def stem(word):
+    if word.endswith('ies') and len(word) > 5:
+        return word[:-3] + 'y'
+    for suffix in STEM_SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            if suffix == 's' and word.endswith('ss'):
+                continue
+            return word[:-len(suffix)]
+    return word
+
+# Stemmed words of text, without stop words and single letters
+def tokenize(text):
+    return [stem(word) for word in re.findall(r'[a-z0-9]+', text.lower()) if len(word) > 1 and word not in STOP_WORDS]
+
+# Build the text index of a spell file over the description, higher levels
+# and materials, postings map a stem to (entry, count) pairs in file order
+def index_spell_text(file, entries):
+    with open(file, 'rb') as f:
+        data = f.read()
+
+    postings = {}
+    lengths = array('i')
+    for i, entry in enumerate(entries):
+        spell = json.loads(data[entry['offset']:entry['offset'] + entry['length']].decode('utf-8'))
+        text = [spell['description'], spell.get('higher_levels', '')]
+        text.extend(spell['components'].get('materials_needed', []))
+
+        counts = {}
+        for token in tokenize(' '.join(text)):
+            counts[token] = counts.get(token, 0) + 1
+        lengths.append(sum(counts.values()))
+        for token, count in counts.items():
+            postings.setdefault(token, []).append((i, count))
+    return {'postings' : postings, 'lengths' : lengths}
+
+# Pack bit positions into an integer bitset
+def bitset(positions, size):
+    data = bytearray((size + 7) // 8)
+    for i in positions:
+        data[i >> 3] = data[i >> 3] | (1 << (i & 7))
+    return int.from_bytes(data, 'little')
+
+# Build the offset index of a spell file
+def index_spell_file(file):
+    with open(file, 'rb') as f:
+        data = f.read()
+
+    # Latin-1 maps bytes to characters one to one, so positions in the
+    # text are byte offsets and multi-byte UTF-8 never looks like JSON syntax
+    text = data.decode('latin-1')
+    decoder = json.JSONDecoder()
+    separator = re.compile(r'[\s,]*')
+
+    entries = []
+    pos = separator.match(text, text.index('[') + 1).end()
+    while text[pos] != ']':
+        _, end = decoder.raw_decode(text, pos)
+        spell = json.loads(data[pos:end].decode('utf-8'))
+        entries.append({
+            'name' : spell['name'],
+            'level' : spell['level'],
+            'school' : spell['school'],
+            'classes' : spell['classes'],
+            'ritual' : spell['ritual'],
+            'components' : ''.join(c[0].upper() for c in ('verbal', 'somatic', 'material') if spell['components'][c]),
+            'offset' : pos,
+            'length' : end - pos
+        })
+        pos = separator.match(text, end).end()
+    return entries
+
+# Load spell file into the spell store
 def populate_spells(file, db):
     try:
-        # Get file handle and read in
-        file_handle = open(file)
-        file_json = json.load(file_handle)
-        file_handle.close()
-
-        # Read in every spell
-        for spell in file_json:
-            db[spell['name']] = spell
+        db.add_file(file)
     except:
         print('[ERROR] problem loading in spells list')
 
+# Table columns shown for every combatant
+TABLE_COLUMNS = ['Name', 'Roll', 'HP', 'INCAP', 'AC', 'DEX', 'Type', 'Lock']
+
+# Terminal rows kept free under a live table for the prompt and command output
+PROMPT_ROWS = 8
+
+# Table row for a combatant
+def combatant_row(c):
+    if c.init_mod >= 0:
+        init = f'+{c.init_mod}'
+    else:
+        init = c.init_mod
+    locked = 'T' if c.locked else 'F'
+    incap = 'T' if c.health <= 0 else 'F'
+    return [c.name, c.roll, c.health, incap, c.ac, init, c.type, locked]
+
+# Turn numbers for the index column, the current turn is marked with >
+def turn_labels(count, turn=None):
+    if turn is None:
+        return [i + 1 for i in range(count)]
+    return [f'>{i + 1}' if i == turn else str(i + 1) for i in range(count)]
+
 # Draw all combatants in table
 def draw_all(combatants):
+    draw_rows([combatant_row(c) for c in combatants], combatants.marked_turn())
+
+# Draw table rows in turn order
+def draw_rows(rows, turn=None):
     # Set table columns
-    table = [['Name', 'Roll', 'HP', 'INCAP', 'AC', 'DEX', 'Type', 'Lock']]
+    table = [TABLE_COLUMNS]
+    table.extend(rows)
 
-    # Add each combatant to the table
-    for c in combatants:
-        if c.init_mod >= 0:
-            init = f'+{c.init_mod}'
-        else:
-            init = c.init_mod
-        locked = 'T' if c.locked else 'F'
-        incap = 'T' if c.health <= 0 else 'F'
-        table.append([c.name, c.roll, c.health, incap, c.ac, init, c.type, locked])
-    
-    turn_nums = [*range(len(combatants))]
-    turn_nums = list(map(lambda x : x + 1, turn_nums))
+    turn_nums = turn_labels(len(rows), turn)
 
     # Draw the table
     print(tabulate.tabulate(
@@ -234,78 +1469,457 @@ def draw_all(combatants):
         stralign='left'
     ))
 
+# Output stream counting the terminal rows written, wrapped lines included,
+# so the renderer knows when command output may have scrolled the last frame
+class _LineCounter:
+    def __init__(self, stream, width=80):
+        self.stream = stream
+        self.width = width
+        self.lines = 0
+        self.column = 0
+
+    # Count rows for text the terminal shows, such as echoed input
+    def count(self, text):
+        for i, part in enumerate(text.split('\n')):
+            if i:
+                self.lines = self.lines + 1
+                self.column = 0
+            if '\r' in part:
+                part = part.rsplit('\r', 1)[1]
+                self.column = 0
+            self.column = self.column + len(part.expandtabs())
+            if self.column > self.width: # Soft wrapped, a full row waits for the next character
+                wrapped = (self.column - 1) // self.width
+                self.lines = self.lines + wrapped
+                self.column = self.column - wrapped * self.width
+
+    def reset(self, width):
+        self.width = width
+        self.lines = 0
+        self.column = 0
+
+    def write(self, text):
+        self.count(text)
+        return self.stream.write(text)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+# Combatant table renderer that keeps the last frame and only rewrites the
+# lines that changed, using ANSI cursor movement instead of clear. Commands
+# print to output so the rows under the table are counted, tables taller
+# than the terminal show the rows around the current turn
+class TableRenderer:
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self.output = _LineCounter(self.stream)
+        self.frame = []
+        self.layout = None
+        self.size = None
+        self.rows = {}
+
+    # Force a full repaint on the next draw
+    def invalidate(self):
+        self.frame = []
+
+    # Count a line the user typed at the prompt, echoed by the terminal
+    def note_input(self, text):
+        self.output.count(text + '\n')
+
+    # Border line in the fancy grid style
+    def border(self, left, fill, middle, right):
+        return left + middle.join(fill * (w + 2) for w in self.layout[0]) + right
+
+    # Content line for one row, cached per row contents and layout
+    def line(self, row):
+        key = tuple(row)
+        line = self.rows.get(key)
+        if line is None:
+            cells = []
+            for value, width, numeric in zip(row, *self.layout):
+                if numeric:
+                    cells.append(str(value).rjust(width))
+                else:
+                    cells.append(str(value).ljust(width))
+            line = '│ ' + ' │ '.join(cells) + ' │'
+            self.rows[key] = line
+        return line
+
+    # Build the lines of the table for the combatants, laid out like
+    # tabulate: numeric columns right aligned, headers padded by two. When
+    # more than height lines are needed only the rows around the turn are
+    # built, followed by a line saying which rows are shown
+    def build(self, combatants, height=None):
+        header = [''] + TABLE_COLUMNS
+        turn = combatants.marked_turn()
+        rows = []
+        for label, c in zip(turn_labels(len(combatants), turn), combatants):
+            rows.append([label] + combatant_row(c))
+
+        widths = []
+        numeric = []
+        for i in range(len(header)):
+            column = [str(row[i]) for row in rows]
+            widths.append(max([len(header[i]) + 2] + [len(value) for value in column]))
+            numeric.append(bool(column) and all(value.lstrip('+-').isdigit() for value in column))
+        layout = (tuple(widths), tuple(numeric))
+        if layout != self.layout:
+            self.layout = layout
+            self.rows = {}
+
+        # Widths come from every row so columns hold still as the window moves
+        visible = rows
+        note = None
+        if height is not None and 3 + 2 * len(rows) > height:
+            count = max(1, (height - 4) // 2)
+            start = min(max((turn or 0) - count // 3, 0), len(rows) - count)
+            visible = rows[start:start + count]
+            note = f'rows {start + 1}-{start + count} of {len(rows)}, following the turn'
+
+        separator = self.border('├', '─', '┼', '┤')
+        frame = [self.border('╒', '═', '╤', '╕'), self.line(header), self.border('╞', '═', '╪', '╡')]
+        for row in visible:
+            frame.append(self.line(row))
+            frame.append(separator)
+
+        # Last separator, or the header one when empty, becomes the bottom
+        frame[-1] = self.border('╘', '═', '╧', '╛')
+        if note:
+            frame.append(note)
+        return frame
+
+    # Draw the combatants, rewriting only changed lines of the last frame
+    def draw(self, combatants):
+        scrolled = self.output.lines
+        size = shutil.get_terminal_size()
+        frame = self.build(combatants, size.lines - PROMPT_ROWS)
+        if frame and len(frame[0]) > size.columns: # Wrapped lines would break row positions
+            frame = [line[:size.columns] for line in frame]
+
+        # Repaint everything if the old frame may have scrolled or resized,
+        # overwriting in place so the screen is never blank
+        out = []
+        if not self.frame or size != self.size or len(self.frame) + scrolled >= size.lines:
+            out.append('\x1b[H')
+            out.append('\x1b[K\n'.join(frame))
+            out.append('\x1b[K\n\x1b[J')
+        else:
+            for i, line in enumerate(frame):
+                if i >= len(self.frame) or self.frame[i] != line:
+                    out.append(f'\x1b[{i + 1};1H{line}\x1b[K')
+
+            # Park the cursor under the table and clear old command output
+            out.append(f'\x1b[{len(frame) + 1};1H\x1b[J')
+        self.stream.write(''.join(out))
+        self.stream.flush()
+
+        self.frame = frame
+        self.size = size
+        self.output.reset(size.columns)
+
 # Advance combat round by rerolling
 def advance_round(combatants):
-    os.system('clear')
     for c in combatants:
         if not c.locked:
             c.reroll()
-    combatants.sort(key=lambda c : int(c.roll), reverse=True)
+    combatants.sort_initiative()
+    combatants.round = combatants.round + 1
 
-# List saved encounters
-def list_encounters():
+# List saved encounters from the library manifest
+def list_encounters(fields):
     try:
-        data_path = os.getcwd() + '/data/'
-        data_list = os.listdir(data_path)
-        for f in data_list:
-            if '.json' in f:
-                print(f.split('.')[0])
-
-        if len(data_list) == 0:
-            print('no encounters found in /data/')
-    except:
-        print('no encounters found in /data/')
+        prefix = ''
+        tag = None
+        rest = fields[1:]
+        if len(rest) >= 2 and rest[-2] == 'tag':
+            tag = rest[-1]
+            rest = rest[:-2]
+        if len(rest) > 1:
+            raise IndexError
+        if rest:
+            prefix = rest[0]
+
+        rows = library.manifest(prefix, tag)
+        if not rows:
+            print('no encounters found')
+            return
+
+        table = [['Name', 'Combatants', 'Players', 'Enemies', 'CR', 'XP', 'Tags']]
+        for name, count, characters, enemies, cr, xp, tags in rows:
+            table.append([name, count, characters, enemies, f'{cr:g}', xp, tags])
+        print(tabulate.tabulate(table, headers='firstrow', tablefmt='simple'))
+    except IndexError:
+        print('usage: list [prefix] [tag <tag>]')
+    except sqlite3.Error:
+        print('encounter library cannot be read')
+
+# Encounter in the json format, players as characters and the rest as enemies
+def encounter_json(combatants):
+    data = {"characters": [], "enemies": []}
+
+    # Serialize each combatant
+    for c in combatants:
+        entry = {
+            "name": c.name,
+            "init_mod": c.init_mod,
+            "health": c.health,
+            "ac" : c.ac,
+            "type" : c.type
+        }
+
+        # Append to the correct list
+        if c.name in players_list:
+            data['characters'].append(entry)
+        else:
+            data['enemies'].append(entry)
+    return data
 
 # Save encounter to json
 def save_json(file, combatants, forced=False):
     try: # Try saving to json
-        data = {"characters": [], "enemies": []}
-
-        # Serialize each combatant
-        for c in combatants:
-            entry = {
-                "name": c.name,
-                "init_mod": c.init_mod,
-                "health": c.health,
-                "ac" : c.ac,
-                "type" : c.type
-            }
-
-            # Append to the correct list
-            if c.name in players_list:
-                data['characters'].append(entry)
-            else:
-                data['enemies'].append(entry)
+        data = encounter_json(combatants)
 
         # Open the file and check forced
         file_path = os.getcwd() + f'/data/{file}.json'
         if os.path.exists(file_path) and not forced:
             print(f'{file}.json already exists, -f to force')
         else:
-            with open(file_path, 'w') as f:
-                json.dump(data, f, indent=4)
+            write_atomic(file_path, json.dumps(data, indent=4).encode())
             print(f'{file}.json saved successfully')
+            return True
     except:
         print(f'{file}.json can\'t be written to')
 
-# Save encoutner
-def save_encounter(fields, combatants):
+# Save encoutner to the library
+def save_encounter(fields, combatants, db):
+    try:
+        if len(fields) not in (2, 3) or (len(fields) == 3 and fields[2] != '-f'):
+            raise IndexError
+        name = fields[1]
+        if not name:
+            raise IndexError
+
+        if library.put(name, encounter_json(combatants), db, len(fields) == 3):
+            print(f'{name} saved successfully')
+        else:
+            print(f'{name} already exists, -f to force')
+    except IndexError:
+        print('usage: save <name> [-f]')
+    except ValueError:
+        print(f'{name} is reserved, choose another name')
+    except sqlite3.Error:
+        print(f'{name} can\'t be written to the library')
+
+# Experience points for each challenge rating
+CR_XP = {
+    0 : 10, 0.125 : 25, 0.25 : 50, 0.5 : 100, 1 : 200, 2 : 450, 3 : 700, 4 : 1100, 5 : 1800,
+    6 : 2300, 7 : 2900, 8 : 3900, 9 : 5000, 10 : 5900, 11 : 7200, 12 : 8400, 13 : 10000,
+    14 : 11500, 15 : 13000, 16 : 15000, 17 : 18000, 18 : 20000, 19 : 22000, 20 : 25000,
+    21 : 33000, 22 : 41000, 23 : 50000, 24 : 62000, 25 : 75000, 26 : 90000, 27 : 105000,
+    28 : 120000, 29 : 135000, 30 : 155000
+}
+
+# Data files in data/ that are not encounters
+RESERVED_ENCOUNTERS = ('autosave', 'players', 'spells')
+
+# Names the library refuses, their files are read directly
+def reserved_encounter(name):
+    return name.lower() in RESERVED_ENCOUNTERS
+
+# Library tables, names compare without case so lookups and prefix ranges use the index
+LIBRARY_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS encounters (
+    name TEXT PRIMARY KEY COLLATE NOCASE,
+    combatants INTEGER NOT NULL,
+    characters INTEGER NOT NULL,
+    enemies INTEGER NOT NULL,
+    cr REAL NOT NULL,
+    xp INTEGER NOT NULL,
+    tags TEXT NOT NULL DEFAULT '',
+    body TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tags (
+    tag TEXT COLLATE NOCASE,
+    name TEXT COLLATE NOCASE,
+    PRIMARY KEY (tag, name)
+);
+'''
+
+# Combatant count, total CR and XP of an encounter, enemies are rated by their
+# catalog entry without the copy suffix
+def encounter_summary(data, db):
+    cr = 0
+    xp = 0
+    for e in data['enemies']:
+        base = split_name(e['name'])[0]
+        if base in db:
+            value = db.columns['cr_value'][db.ids[base]]
+            if value == value and value != MISSING:
+                cr = cr + value
+                xp = xp + CR_XP.get(value, 0)
+    characters = len(data['characters'])
+    enemies = len(data['enemies'])
+    return characters + enemies, characters, enemies, cr, xp
+
+# Saved encounters in one SQLite file, each stored in the json encounter format
+# next to a manifest row so listing never reads an encounter body
+class EncounterLibrary:
+    def __init__(self, path='data/encounters.db'):
+        self.path = path
+        self.connection = None
+
+    def exists(self):
+        return self.connection is not None or os.path.exists(self.path)
+
+    # Daemon clients run on their own threads, the daemon lock serializes them
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.executescript(LIBRARY_SCHEMA)
+        return self.connection
+
+    def contains(self, name):
+        if not self.exists():
+            return False
+        return self.connect().execute('SELECT 1 FROM encounters WHERE name = ?', (name,)).fetchone() is not None
+
+    # Encounter json by name ignoring case, None when missing
+    def get(self, name):
+        if not self.exists():
+            return None
+        row = self.connect().execute('SELECT body FROM encounters WHERE name = ?', (name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    # Store an encounter, False if the name is taken and not forced,
+    # ValueError for reserved names
+    def put(self, name, data, db, forced=False):
+        if reserved_encounter(name):
+            raise ValueError(f'{name} is reserved')
+        connection = self.connect()
+        with connection:
+            if not forced and connection.execute('SELECT 1 FROM encounters WHERE name = ?', (name,)).fetchone():
+                return False
+            connection.execute(
+                'INSERT INTO encounters (name, combatants, characters, enemies, cr, xp, body) VALUES (?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (name) DO UPDATE SET combatants = excluded.combatants, characters = excluded.characters, '
+                'enemies = excluded.enemies, cr = excluded.cr, xp = excluded.xp, body = excluded.body',
+                (name,) + encounter_summary(data, db) + (json.dumps(data),))
+        return True
+
+    # Manifest rows in name order, optionally under a prefix and with a tag
+    def manifest(self, prefix='', tag=None):
+        if not self.exists():
+            return []
+        query = 'SELECT e.name, e.combatants, e.characters, e.enemies, e.cr, e.xp, e.tags FROM encounters e'
+        args = []
+        if tag:
+            query = query + ' JOIN tags t ON t.name = e.name AND t.tag = ?'
+            args.append(tag)
+        if prefix: # Range over the name index, \U0010ffff sorts after any continuation
+            query = query + ' WHERE e.name >= ? AND e.name < ?'
+            args.extend([prefix, prefix + '\U0010ffff'])
+        return self.connect().execute(query + ' ORDER BY e.name', args).fetchall()
+
+    def delete(self, name):
+        connection = self.connect()
+        with connection:
+            connection.execute('DELETE FROM tags WHERE name = ?', (name,))
+            return connection.execute('DELETE FROM encounters WHERE name = ?', (name,)).rowcount > 0
+
+    # Add or remove tags, False if the encounter is missing
+    def tag(self, name, tags, add=True):
+        connection = self.connect()
+        with connection:
+            row = connection.execute('SELECT name FROM encounters WHERE name = ?', (name,)).fetchone()
+            if not row:
+                return False
+            for tag in tags:
+                if add:
+                    connection.execute('INSERT OR IGNORE INTO tags (tag, name) VALUES (?, ?)', (tag.lower(), row[0]))
+                else:
+                    connection.execute('DELETE FROM tags WHERE tag = ? AND name = ?', (tag, row[0]))
+            current = [r[0] for r in connection.execute('SELECT tag FROM tags WHERE name = ? ORDER BY tag', (row[0],))]
+            connection.execute('UPDATE encounters SET tags = ? WHERE name = ?', (' '.join(current), row[0]))
+        return True
+
+    # Import a json encounter file or every encounter file in a directory,
+    # returns the names imported
+    def import_path(self, path, db, forced=False):
+        if os.path.isdir(path):
+            files = [os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith('.json')]
+        else:
+            files = [path]
+
+        imported = []
+        for file in files:
+            name = os.path.basename(file)[:-5] if file.endswith('.json') else os.path.basename(file)
+            if reserved_encounter(name):
+                continue
+            try:
+                with open(file) as f:
+                    data = json.load(f)
+                data = {'characters' : data['characters'], 'enemies' : data['enemies']}
+            except (OSError, ValueError, KeyError, TypeError): # Not an encounter file
+                continue
+            if self.put(name, data, db, forced):
+                imported.append(name)
+        return imported
+
+    # Create the library from the json encounters in data/ the first time it is used
+    def migrate(self, db, directory='data'):
+        if self.exists():
+            return []
+        return self.import_path(directory, db)
+
+# Library used by load, save, list and add
+library = EncounterLibrary()
+
+# Import, export, tag and delete library encounters
+def manage_library(fields, db):
     try:
-        if len(fields) == 3 and fields[2] == '-f':
-            save_json(fields[1], combatants, True)
+        action = fields[1]
+        if action == 'import' and len(fields) >= 3:
+            forced = fields[-1] == '-f'
+            paths = fields[2:-1] if forced else fields[2:]
+            for path in paths:
+                if not os.path.isdir(path) and reserved_encounter(os.path.basename(path).removesuffix('.json')):
+                    print(f'{path} is a reserved data file, not an encounter')
+                    continue
+                imported = library.import_path(path, db, forced)
+                print(f'imported {len(imported)} encounter(s) from {path}' + (f': {", ".join(imported)}' if imported else ''))
+        elif action == 'export' and len(fields) in (3, 4):
+            name = fields[2]
+            data = library.get(name)
+            if data is None:
+                print(f'{name} cannot be found')
+                return
+            path = fields[3] if len(fields) == 4 else os.getcwd() + f'/data/{name}.json'
+            write_atomic(path, json.dumps(data, indent=4).encode())
+            print(f'{name} exported to {path}')
+        elif action in ('tag', 'untag') and len(fields) >= 4:
+            if library.tag(fields[2], fields[3:], action == 'tag'):
+                print(f'{fields[2]} tags updated')
+            else:
+                print(f'{fields[2]} cannot be found')
+        elif action == 'delete' and len(fields) == 3:
+            if library.delete(fields[2]):
+                print(f'{fields[2]} deleted')
+            else:
+                print(f'{fields[2]} cannot be found')
         else:
-            save_json(fields[1], combatants)
+            raise IndexError
     except IndexError:
-        print('usage: save <file> [-f]')
+        print('usage: library <import <file|dir> [...] [-f]|export <name> [file]|tag <name> <tag> [...]|untag <name> <tag> [...]|delete <name>>')
+    except (OSError, sqlite3.Error) as e:
+        print(f'library error: {e}')
 
 # Load encoutner
 def load_encounter(fields, combatants, db):
-    combatants_backup = []
     players_backup = []
 
-    # Create a deep copy of combatants and players
-    for c in combatants:
-        add_combatant(c, combatants_backup)
+    # Create a copy of combatants and players
+    combatants_backup = list(combatants)
+    state_backup = (combatants.round, combatants.turn, combatants.ordered)
     for p in players_list:
         players_backup.append(p)
 
@@ -321,9 +1935,10 @@ def load_encounter(fields, combatants, db):
     except:
         print('unknown error loading, restoring backup')
 
-    # Restore from deep copy
-    for c in combatants_backup:
-        add_combatant(c, combatants)
+    # Restore from copy
+    combatants.clear()
+    combatants.extend(combatants_backup)
+    combatants.round, combatants.turn, combatants.ordered = state_backup
 
     # Restore players from deep copy
     players_list.clear()
@@ -331,52 +1946,306 @@ def load_encounter(fields, combatants, db):
         players_list.append(p)
     players_list.sort()
 
-# Parse monster health rolls
-def parse_roll(roll_str):
-    # Start lists
-    nums = []
-    delimiters = []
-    start_i = 0
-
-    # Iterate through string and save numbers and delimiters
-    for i in range(len(roll_str)):
-        if not roll_str[i].isdigit():
-            nums.append(roll_str[start_i:i])
-            delimiters.append(roll_str[i])
-            start_i = i + 1
-    nums.append(roll_str[start_i:])
-
-    # Cannot have more operands than numbers
-    if len(nums) == len(delimiters):
-        print(f'PROBLEM: {roll_str} : {nums}, {delimiters}')
-
-    sum = 0
-    num_i = 0
-    del_i = 0
-
-    # Iterate through all of both lists
-    while(num_i < len(nums) and del_i < len(delimiters)):
-        if delimiters[del_i] == 'd': # Roll
-            mult = int(nums[num_i])
-            size = int(nums[num_i + 1])
-
-            # Roll mult times
-            for i in range(mult):
-                sum = sum + random.randint(1, size)
-
-            # Increment num_i by 2
-            num_i = num_i + 2
-        elif delimiters[del_i] == '+': # Add
-            sum = sum + int(nums[num_i])
-            num_i = num_i + 1
-        elif delimiters[del_i] == '-': # Subtract
-            sum = sum - int(nums[num_i])
-            num_i = num_i + 1            
-        else:
-            print(f'unknown operator: {nums}, {delimiters}, {roll_str}')
-            raise Exception('operator error')
-        del_i = del_i + 1
-    return sum
+# Largest distribution support and convolution work done when compiling rolls
+DICE_SUPPORT_LIMIT = 4096
+DICE_WORK_LIMIT = 2000000
+
+# Dice expression tokens
+DICE_TOKEN = re.compile(r'\s*(\d+|kh|kl|k|d|\+|-|\*)')
+
+# Convolve two distributions of {total : weight}
+def convolve(left, right, op):
+    result = {}
+    for a, weight_a in left.items():
+        for b, weight_b in right.items():
+            value = op(a, b)
+            result[value] = result.get(value, 0) + weight_a * weight_b
+    return result
+
+# Constant term of a dice expression
+class _Constant:
+    def __init__(self, value):
+        self.value = value
+
+    def roll(self, rng):
+        return self.value
+
+    def average(self):
+        return self.value
+
+    def minimum(self):
+        return self.value
+
+    def maximum(self):
+        return self.value
+
+    def distribution(self):
+        return {self.value : 1}
+
+# NdM term, optionally keeping the highest or lowest K dice
+class _Dice:
+    def __init__(self, count, size, keep=None, highest=True):
+        if size < 1:
+            raise ValueError(f'd{size} has no faces')
+        self.count = count
+        self.size = size
+        self.keep = count if keep is None else min(keep, count)
+        self.highest = highest
+        self.dist = None
+        self.dist_built = False
+
+    def roll(self, rng):
+        if self.keep == self.count:
+            return sum([rng.randint(1, self.size) for _ in range(self.count)])
+        dice = sorted([rng.randint(1, self.size) for _ in range(self.count)], reverse=self.highest)
+        return sum(dice[:self.keep])
+
+    def average(self):
+        if self.keep == self.count:
+            return self.count * (self.size + 1) / 2
+        dist = self.distribution()
+        if dist is None: # Too many outcomes to enumerate, estimate instead
+            rng = random.Random(0)
+            return sum([self.roll(rng) for _ in range(10000)]) / 10000
+        return sum(value * weight for value, weight in dist.items()) / sum(dist.values())
+
+    def minimum(self):
+        return self.keep
+
+    def maximum(self):
+        return self.keep * self.size
+
+    def distribution(self):
+        if not self.dist_built:
+            self.dist_built = True
+            self.dist = self.build_distribution()
+        return self.dist
+
+    def build_distribution(self):
+        face = {value : 1 for value in range(1, self.size + 1)}
+        if self.keep == self.count: # Sum of dice, convolve one die at a time
+            if self.count * self.count * self.size * self.size > 2 * DICE_WORK_LIMIT:
+                return None
+            dist = {0 : 1}
+            for _ in range(self.count):
+                dist = convolve(dist, face, lambda a, b : a + b)
+            return dist
+
+        # Keep highest/lowest, enumerate every outcome
+        if self.size ** self.count > DICE_WORK_LIMIT // 100:
+            return None
+        dist = {}
+        for dice in itertools.product(range(1, self.size + 1), repeat=self.count):
+            value = sum(sorted(dice, reverse=self.highest)[:self.keep])
+            dist[value] = dist.get(value, 0) + 1
+        return dist
+
+# Sum of signed terms
+class _Sum:
+    def __init__(self, terms):
+        self.terms = terms
+
+    def roll(self, rng):
+        total = 0
+        for sign, term in self.terms:
+            total = total + sign * term.roll(rng)
+        return total
+
+    def average(self):
+        return sum(sign * term.average() for sign, term in self.terms)
+
+    def minimum(self):
+        return sum(term.minimum() if sign > 0 else -term.maximum() for sign, term in self.terms)
+
+    def maximum(self):
+        return sum(term.maximum() if sign > 0 else -term.minimum() for sign, term in self.terms)
+
+    def distribution(self):
+        dist = {0 : 1}
+        for sign, term in self.terms:
+            term_dist = term.distribution()
+            if term_dist is None or len(dist) * len(term_dist) > DICE_WORK_LIMIT:
+                return None
+            dist = convolve(dist, term_dist, lambda a, b : a + sign * b)
+        return dist
+
+# Product of factors
+class _Product:
+    def __init__(self, factors):
+        self.factors = factors
+
+    def roll(self, rng):
+        total = 1
+        for factor in self.factors:
+            total = total * factor.roll(rng)
+        return total
+
+    def average(self):
+        total = 1
+        for factor in self.factors: # Factors are independent
+            total = total * factor.average()
+        return total
+
+    def bounds(self):
+        low = high = 1
+        for factor in self.factors:
+            corners = [a * b for a in (low, high) for b in (factor.minimum(), factor.maximum())]
+            low = min(corners)
+            high = max(corners)
+        return low, high
+
+    def minimum(self):
+        return self.bounds()[0]
+
+    def maximum(self):
+        return self.bounds()[1]
+
+    def distribution(self):
+        dist = {1 : 1}
+        for factor in self.factors:
+            factor_dist = factor.distribution()
+            if factor_dist is None or len(dist) * len(factor_dist) > DICE_WORK_LIMIT:
+                return None
+            dist = convolve(dist, factor_dist, lambda a, b : a * b)
+        return dist
+
+# Compiled dice expression
+class DiceRoll:
+    def __init__(self, text, root):
+        self.text = text
+        self.root = root
+        self.sampler = None
+        self.sampler_built = False
+
+    # Outcomes and cumulative weights, None if the support is too large
+    def build_sampler(self):
+        self.sampler_built = True
+        dist = self.root.distribution()
+        if dist is not None and len(dist) <= DICE_SUPPORT_LIMIT:
+            values = sorted(dist)
+            self.sampler = (values, list(itertools.accumulate(dist[v] for v in values)))
+
+    def roll(self, rng=random):
+        return self.root.roll(rng)
+
+    def average(self):
+        return math.floor(self.root.average())
+
+    def maximum(self):
+        return self.root.maximum()
+
+    # Roll n totals, drawn in one call from the exact distribution when known
+    def batch(self, n, rng=random):
+        if n < 8: # Not worth building the distribution
+            return [self.root.roll(rng) for _ in range(n)]
+        if not self.sampler_built:
+            self.build_sampler()
+        if self.sampler is None:
+            return [self.root.roll(rng) for _ in range(n)]
+        values, cum_weights = self.sampler
+        return rng.choices(values, cum_weights=cum_weights, k=n)
+
+# Compile a dice expression such as 2d8+3, 4d6kh3, 1d4*2 or 2d20kl1-1
+@functools.lru_cache(maxsize=1024)
+def compile_roll(roll_str):
+    tokens = []
+    pos = 0
+    text = roll_str.strip().lower()
+    while pos < len(text):
+        match = DICE_TOKEN.match(text, pos)
+        if not match:
+            raise ValueError(f'unknown operator in {roll_str}')
+        tokens.append(match.group(1))
+        pos = match.end()
+
+    if not tokens: # Empty rolls count as zero
+        return DiceRoll(roll_str, _Constant(0))
+
+    pos = 0
+
+    def peek():
+        return tokens[pos] if pos < len(tokens) else None
+
+    def take():
+        nonlocal pos
+        token = peek()
+        pos = pos + 1
+        return token
+
+    def number():
+        token = take()
+        if token is None or not token.isdigit():
+            raise ValueError(f'expected number in {roll_str}')
+        return int(token)
+
+    def factor():
+        count = number() if peek() != 'd' else 1
+        if peek() != 'd':
+            return _Constant(count)
+        take()
+        size = number()
+        if peek() in ('k', 'kh', 'kl'):
+            highest = take() != 'kl'
+            return _Dice(count, size, number(), highest)
+        return _Dice(count, size)
+
+    def term():
+        factors = [factor()]
+        while peek() == '*':
+            take()
+            factors.append(factor())
+        return factors[0] if len(factors) == 1 else _Product(factors)
+
+    terms = []
+    sign = 1
+    if peek() in ('+', '-'):
+        sign = -1 if take() == '-' else 1
+    terms.append((sign, term()))
+    while peek() in ('+', '-'):
+        sign = -1 if take() == '-' else 1
+        terms.append((sign, term()))
+    if peek() is not None:
+        raise ValueError(f'unknown operator in {roll_str}')
+
+    return DiceRoll(roll_str, _Sum(terms))
+
+# Parse monster health rolls, mode is roll, average or max
+def parse_roll(roll_str, mode='roll'):
+    dice = compile_roll(roll_str)
+    if mode == 'average':
+        return dice.average()
+    elif mode == 'max':
+        return dice.maximum()
+    return dice.roll()
+
+# Roll a dice expression n times
+def roll_batch(roll_str, n, mode='roll'):
+    if mode != 'roll':
+        return [parse_roll(roll_str, mode)] * n
+    return compile_roll(roll_str).batch(n)
+
+# Roll a dice expression from the command line
+def roll_dice(fields):
+    try:
+        mode = 'roll'
+        count = 1
+        for f in fields[2:]:
+            if f in ('roll', 'average', 'avg', 'max'):
+                mode = 'average' if f == 'avg' else f
+            else:
+                count = int(f)
+
+        results = roll_batch(fields[1], count, mode)
+        print(f'{fields[1]} : {", ".join(str(r) for r in results)}')
+        if count > 1:
+            print(f'total {sum(results)}, mean {sum(results) / count:.2f}')
+    except:
+        print('usage: dice <expression> [roll|average|max] [#]')
+
+# Print did you mean suggestions, if any
+def print_suggestions(suggestions):
+    if suggestions:
+        print(f'did you mean: {", ".join(suggestions)}?')
 
 # Add combatant to encounter
 def add_to_encounter(fields, combatants, db):
@@ -393,11 +2262,7 @@ def add_to_encounter(fields, combatants, db):
             if fields[1] == '':
                 raise IndexError('empty name')
 
-            matches = []
-            for name in db:
-                if name.lower().find(fields[1].lower()) != -1:
-                    matches.append(name)
-            matches.sort(key=len)
+            matches = db.find(fields[1])
     
             # Combatant fields
             name = matches[0]
@@ -411,8 +2276,7 @@ def add_to_encounter(fields, combatants, db):
             # Add combatant
             if len(fields) == 3:
                 print(f'adding {fields[2]} {name}(s), {db[name]["roll"]} HP:')
-                for i in range(int(fields[2])):
-                    health = parse_roll(db[name]['roll'])
+                for health in roll_batch(db[name]['roll'], int(fields[2])):
                     add_combatant(Combatant(name, dex_mod, health, ac, e_type), combatants)
                     print(f'{name} : {dex_mod} DEX, {health} HP, {ac} AC, {e_type}')
             else:
@@ -429,7 +2293,12 @@ def add_to_encounter(fields, combatants, db):
                     add_combatant(Combatant(fields[1], int(fields[2]), int(fields[3]), int(fields[4]), fields[5]), combatants) 
                     print(f'added {fields[1]} : {fields[2]} DEX, {fields[3]} HP, {fields[4]} AC, {fields[5]}')                        
             except IndexError:
-                print(f'usage:\nadd from file:\tadd <file>\nadd from db:\tadd <name> [#]\nadd custom:\tadd <name> <dex_mod> <hp> <ac> <type> [#]')
+                suggestions = db.suggest(fields[1]) if len(fields) in (2, 3) and fields[1] else []
+                if suggestions: # Likely a typo of a catalog name
+                    print(f'{fields[1]} cannot be found')
+                    print_suggestions(suggestions)
+                else:
+                    print(f'usage:\nadd from file:\tadd <file>\nadd from db:\tadd <name> [#]\nadd custom:\tadd <name> <dex_mod> <hp> <ac> <type> [#]')
     
     # Restore players from deep copy
     players_list.clear()
@@ -447,35 +2316,37 @@ def remove_from_encounter(fields, combatants):
             if n == '*':
                 continue
 
-            remove_buffer = []
+            # Build remove buffer, a trailing * makes every name a prefix
+            if fields[-1] == '*':
+                remove_buffer = combatants.find_prefix(n)
+            elif n.endswith('*'):
+                remove_buffer = combatants.find_prefix(n[:-1])
+            else:
+                remove_buffer = combatants.find(n)[:1] # Force exact match
 
-            # Build remove buffer
-            for c in combatants:
-                if fields[-1] == '*':
-                    if c.name.lower().startswith(n.lower()):
-                        remove_buffer.append(c)
-                else:
-                    if c.name.lower() == n.lower(): # CHANGED THIS TO FORCE EXACT MATCH
-                        remove_buffer.append(c)
-                        break
+            if not remove_buffer:
+                print(f'{n} cannot be found')
+                print_suggestions(combatants.suggest(n))
+                continue
 
             remove_buffer.sort(key=lambda c : c.name)
             name = remove_buffer[0].name.split('_')[0]
 
             # Execute removal
+            round_before = combatants.round
             for r in remove_buffer:
                 combatants.remove(r)
 
-            if not remove_buffer:
-                print(f'{n} cannot be found')
-            else:
-                print(f'{len(remove_buffer)} {name}(s) removed successfully')
+            print(f'{len(remove_buffer)} {name}(s) removed successfully')
+            if combatants.round != round_before: # The last turn of the round left
+                print(f'round {combatants.round}')
     except:
         print(f'usage: remove <name>')   
 
 # Save and exit program
-def save_and_exit(combatants):
-    save_json('autosave', combatants, True)
+def save_and_exit(combatants, journal=None):
+    if save_json('autosave', combatants, True) and journal: # Retired only once the autosave is written
+        journal.retire()
     print('exiting...')
     exit(0)
 
@@ -520,18 +2391,23 @@ def search_history(hist, fields):
     return hist[location]
 
 # Manually enter all players initiative
-def roll_players(combatants):
-    print('order: ' + ', '.join(players_list))
-    rolls = input().split(' ')
+def roll_players(combatants, fields=None):
+    if fields and len(fields) > 1: # Rolls given inline
+        rolls = fields[1:]
+    else:
+        print('order: ' + ', '.join(players_list))
+        rolls = input().split(' ')
 
     if len(rolls) != len(players_list):
         print('must supply one roll per player')
+    elif not all(r.lstrip('-').isdigit() for r in rolls):
+        print('rolls must be whole numbers')
     else:
         for p, r in zip(players_list, rolls):
             print(f'{p} : {r}')
             for c in combatants:
                 if c.name == p:
-                    c.roll = r
+                    c.roll = int(r)
     
     for c in combatants:
         if c.name in players_list:
@@ -540,65 +2416,434 @@ def roll_players(combatants):
             c.reroll()
 
 # Manually edit a combatant
-def edit_combatant(fields, combatants):
+def edit_combatant(fields, combatants, session=None):
     try: # Attempt edit
-        found = False
-        for c in combatants:
-            if c.name.lower() == fields[1].lower():
-                found = True
-                if fields[2].startswith('name'): # Edit name
-                    c.name = fields[3]
-                elif fields[2].startswith('roll'): # Edit roll
-                    c.roll = int(fields[3])
-                elif fields[2].startswith('hp'): # Edit HP
-                    c.health = int(fields[3])
-                elif fields[2].startswith('ac'): # Edit AC
-                    c.ac = int(fields[3])
-                elif fields[2].startswith('dex'): # Edit dex_mod
-                    c.init_mod = int(fields[3])
-                elif fields[2].startswith('type'): # Edit type
-                    c.type = fields[3]
-                else: # Non-valid field
-                    print(f'{fields[2]} is not a valid field')
-                    raise Exception('invalid field')
-                print(f'{c.name}\'s {fields[2]} updated to {fields[3]}')
-        if not found:
-            print(f'{fields[1]} cannot be find')
+        matches = combatants.find(fields[1])
+        for c in matches:
+            if fields[2].startswith('name'): # Edit name
+                combatants.rename(c, fields[3])
+            elif fields[2].startswith('roll'): # Edit roll, moves to its place in the order
+                combatants.update(c, 'roll', int(fields[3]))
+            elif fields[2].startswith('hp'): # Edit HP
+                c.health = int(fields[3])
+            elif fields[2].startswith('ac'): # Edit AC
+                c.ac = int(fields[3])
+            elif fields[2].startswith('dex'): # Edit dex_mod, breaks roll ties
+                combatants.update(c, 'init_mod', int(fields[3]))
+                if session and c.name in players_list: # Players share DEX across encounters
+                    session.reorder(c)
+            elif fields[2].startswith('type'): # Edit type
+                c.type = sys.intern(fields[3])
+            else: # Non-valid field
+                print(f'{fields[2]} is not a valid field')
+                raise Exception('invalid field')
+            print(f'{c.name}\'s {fields[2]} updated to {fields[3]}')
+        if not matches:
+            print(f'{fields[1]} cannot be found')
+            print_suggestions(combatants.suggest(fields[1]))
     except: # Print edit usage
         print('usage: edit <name> <field> <value>\nfields: name, roll, hp, ac, dex, type')
 
-# Lock combatant initiative
+# Lock combatant initiative, names ending in * lock every match
 def lock_combatant(fields, combatants):
     try: # Try locking
         if len(fields) == 1:
             print('usage: lock <name>')
             return
         for n in fields[1:]:
-            for c in combatants:
-                if c.name.lower() == n.lower():
-                    c.locked = not c.locked
-                    if c.locked:
-                        print(f'{c.name} locked')
-                    else:
-                        print(f'{c.name} unlocked')
+            matches = combatants.match(n)
+            if not matches:
+                print(f'{n} cannot be found')
+                print_suggestions(combatants.suggest(n))
+            for c in matches:
+                c.locked = not c.locked
+                if c.locked:
+                    print(f'{c.name} locked')
+                else:
+                    print(f'{c.name} unlocked')
     except: # Wrong usage
         print('usage: lock <name>')
 
-# Damage combatant
+# Damage combatant, every name before the amount is a target
 def damage_combatant(fields, combatants, damaging):
     try:
-        if len(fields) == 1:
-            print('usage: [damage|heal] <name> <#>')
+        if len(fields) < 3:
+            print('usage: [damage|heal] <name> [<name> ...] <#>')
             return
-        for c in combatants:
-            if c.name.lower() == fields[1].lower():
+        amount = int(fields[-1])
+        for n in fields[1:-1]:
+            matches = combatants.match(n)
+            if not matches:
+                print(f'{n} cannot be found')
+                print_suggestions(combatants.suggest(n))
+            for c in matches:
                 if damaging:
-                    c.health = c.health - int(fields[2])
+                    c.health = c.health - amount
                 else:
-                    c.health = c.health + int(fields[2])
+                    c.health = c.health + amount
                 print(f'{c.name}\'s health changed to {c.health}')
     except:
-        print('usage: [damage|heal] <name> <#>')
+        print('usage: [damage|heal] <name> [<name> ...] <#>')
+
+# Attack bonus, average damage per round and highest HP for each CR, from
+# the DMG monster statistics by challenge rating table
+CR_STATS = [
+    (0, 3, 1, 6), (0.125, 3, 2.5, 35), (0.25, 3, 4.5, 49), (0.5, 3, 7, 70),
+    (1, 3, 11.5, 85), (2, 3, 17.5, 100), (3, 4, 23.5, 115), (4, 5, 29.5, 130),
+    (5, 6, 35.5, 145), (6, 6, 41.5, 160), (7, 6, 47.5, 175), (8, 7, 53.5, 190),
+    (9, 7, 59.5, 205), (10, 7, 65.5, 220), (11, 8, 71.5, 235), (12, 8, 77.5, 250),
+    (13, 8, 83.5, 265), (14, 8, 89.5, 280), (15, 8, 95.5, 295), (16, 9, 101.5, 310),
+    (17, 10, 107.5, 325), (18, 10, 113.5, 340), (19, 10, 119.5, 355), (20, 10, 131.5, 400),
+    (21, 11, 149.5, 445), (22, 11, 167.5, 490), (23, 11, 185.5, 535), (24, 12, 203.5, 580),
+    (25, 12, 221.5, 625), (26, 12, 239.5, 670), (27, 13, 257.5, 715), (28, 13, 275.5, 760),
+    (29, 13, 293.5, 805), (30, 14, 311.5, 850)
+]
+
+# Simulation limits
+SIMULATION_ROUND_LIMIT = 100
+SIMULATION_CHUNK = 2500
+DAMAGE_TABLE_SIZE = 1024
+
+# Attack bonus and average damage per round for a challenge rating
+def cr_profile(cr):
+    for stats in CR_STATS:
+        if cr <= stats[0]:
+            return stats[1], stats[2]
+    return CR_STATS[-1][1], CR_STATS[-1][2]
+
+# Estimate a challenge rating from hit points for custom combatants
+def cr_from_health(health):
+    for stats in CR_STATS:
+        if health <= stats[3]:
+            return stats[0]
+    return CR_STATS[-1][0]
+
+# Rough attack bonus and average damage per round of a player character
+def player_profile(level):
+    proficiency = 2 + (level - 1) // 4
+    modifier = 3 if level < 4 else 4 if level < 8 else 5
+    return proficiency + modifier, 6 + 2.5 * level
+
+# Quantile table of a damage roll averaging about damage, indexed uniformly
+def damage_table(damage):
+    dice = max(1, round(damage * 0.6 / 3.5))
+    bonus = round(damage - dice * 3.5)
+    roll = f'{dice}d6' + (f'+{bonus}' if bonus >= 0 else f'{bonus}')
+
+    dist = compile_roll(roll).root.distribution()
+    values = sorted(dist)
+    cum_weights = list(itertools.accumulate(dist[v] for v in values))
+    total = cum_weights[-1]
+
+    table = []
+    for i in range(DAMAGE_TABLE_SIZE):
+        target = (i + 0.5) * total / DAMAGE_TABLE_SIZE
+        table.append(max(0, values[bisect.bisect_left(cum_weights, target)]))
+    return table
+
+# Build the picklable simulation spec for every combatant still standing
+def simulation_spec(combatants, db, level):
+    spec = []
+    for c in sorted(combatants, key=lambda c : c.joined): # Ties go to join order as in play
+        if c.health <= 0:
+            continue
+
+        if c.name in players_list:
+            side = 0
+            attack, damage = player_profile(level)
+        else:
+            side = 1
+            base = split_name(c.name)[0]
+            if base in db and db[base]['cr_value'] == db[base]['cr_value']:
+                cr = db[base]['cr_value']
+            else:
+                cr = cr_from_health(c.health)
+            attack, damage = cr_profile(cr)
+
+        spec.append((c.name, side, c.health, c.ac, c.init_mod, c.locked, c.roll, attack, damage_table(damage)))
+    return spec
+
+# Run trials of a combat on a private generator, returns raw tallies
+def _simulate_chunk(spec, trials, seed):
+    rand = random.Random(seed).random
+    n = len(spec)
+    side = [s[1] for s in spec]
+    init_mod = [s[4] for s in spec]
+    unlocked = [i for i in range(n) if not spec[i][5]]
+    ac = [s[3] for s in spec]
+    attack = [s[7] for s in spec]
+    table = [s[8] for s in spec]
+
+    wins = 0
+    total_rounds = 0
+    drops = [0] * n
+
+    for _ in range(trials):
+        health = [s[2] for s in spec]
+        rolls = [s[6] for s in spec]
+        alive = [[i for i in range(n) if side[i] == 0], [i for i in range(n) if side[i] == 1]]
+
+        rounds = 0
+        while alive[0] and alive[1] and rounds < SIMULATION_ROUND_LIMIT:
+            rounds = rounds + 1
+
+            # Reroll like advance_round, locked combatants keep their roll
+            for i in unlocked:
+                rolls[i] = int(rand() * 20) + 1 + init_mod[i]
+            order = sorted(range(n), key=lambda i : (rolls[i], init_mod[i]), reverse=True)
+
+            for i in order:
+                if health[i] <= 0:
+                    continue
+                foes = alive[1 - side[i]]
+                if not foes:
+                    break
+
+                # Attack a random foe, natural 20 always hits and 1 always misses
+                target = foes[int(rand() * len(foes))]
+                d20 = int(rand() * 20) + 1
+                if d20 == 20 or (d20 != 1 and d20 + attack[i] >= ac[target]):
+                    health[target] = health[target] - table[i][int(rand() * DAMAGE_TABLE_SIZE)]
+                    if health[target] <= 0:
+                        foes.remove(target)
+                        drops[target] = drops[target] + 1
+
+        total_rounds = total_rounds + rounds
+        if alive[0] and not alive[1]:
+            wins = wins + 1
+
+    return wins, total_rounds, drops, trials
+
+# Simulate the current combat, trials are split into fixed seeded chunks
+# so results only depend on the seed, not on the number of workers
+def simulate_combat(combatants, db, trials=10000, level=1, seed=0, workers=None):
+    spec = simulation_spec(combatants, db, level)
+    chunks = []
+    for i in range(0, trials, SIMULATION_CHUNK):
+        chunks.append((spec, min(SIMULATION_CHUNK, trials - i), seed * 1000003 + i // SIMULATION_CHUNK))
+
+    results = None
+    if len(chunks) > 1 and workers != 1:
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(_simulate_chunk, *zip(*chunks)))
+        except: # No process pool available, run in process
+            results = None
+    if results is None:
+        results = [_simulate_chunk(*chunk) for chunk in chunks]
+
+    wins = sum(r[0] for r in results)
+    rounds = sum(r[1] for r in results)
+    drops = [sum(r[2][i] for r in results) for i in range(len(spec))]
+    return {
+        'trials' : trials,
+        'win' : wins / trials,
+        'rounds' : rounds / trials,
+        'drops' : {spec[i][0] : drops[i] / trials for i in range(len(spec)) if spec[i][1] == 0}
+    }
+
+# Simulate combat outcomes from the command line
+def simulate_encounter(fields, combatants, db):
+    try:
+        trials = 10000
+        level = 1
+        seed = 0
+        i = 1
+        while i < len(fields):
+            if fields[i] == 'level':
+                level = int(fields[i + 1])
+                i = i + 1
+            elif fields[i] == 'seed':
+                seed = int(fields[i + 1])
+                i = i + 1
+            else:
+                trials = int(fields[i])
+            i = i + 1
+        if trials < 1 or level < 1:
+            raise ValueError('trials and level must be positive')
+
+        start = time.perf_counter()
+        result = simulate_combat(combatants, db, trials, level, seed)
+        elapsed = time.perf_counter() - start
+
+        print(f'{trials} trials in {elapsed:.2f}s')
+        print(f'win probability: {result["win"] * 100:.1f}%')
+        print(f'expected rounds: {result["rounds"]:.1f}')
+        for name, chance in result['drops'].items():
+            print(f'{name} drops to 0 HP: {chance * 100:.1f}%')
+    except:
+        print('usage: simulate [trials] [level <party level>] [seed <seed>]')
+
+# XP thresholds per character for easy, medium, hard and deadly encounters, by level
+XP_THRESHOLDS = {
+    1 : (25, 50, 75, 100), 2 : (50, 100, 150, 200), 3 : (75, 150, 225, 400), 4 : (125, 250, 375, 500),
+    5 : (250, 500, 750, 1100), 6 : (300, 600, 900, 1400), 7 : (350, 750, 1100, 1700), 8 : (450, 900, 1400, 2100),
+    9 : (550, 1100, 1600, 2400), 10 : (600, 1200, 1900, 2800), 11 : (800, 1600, 2400, 3600),
+    12 : (1000, 2000, 3000, 4500), 13 : (1100, 2200, 3400, 5100), 14 : (1250, 2500, 3800, 5700),
+    15 : (1400, 2800, 4300, 6400), 16 : (1600, 3200, 4800, 7200), 17 : (2000, 3900, 5900, 8800),
+    18 : (2100, 4200, 6300, 9500), 19 : (2400, 4900, 7300, 10900), 20 : (2800, 5700, 8500, 12700)
+}
+DIFFICULTIES = ('easy', 'medium', 'hard', 'deadly')
+
+# XP multipliers for the number of monsters, stepped up for small parties
+# and down for large ones
+ENCOUNTER_MULTIPLIERS = (0.5, 1, 1.5, 2, 2.5, 3, 4, 5)
+
+# Most search steps one build may take, keeps it bounded and repeatable
+BUILD_NODE_LIMIT = 200000
+
+def encounter_multiplier(count, party_size):
+    if count <= 2:
+        step = count
+    elif count <= 6:
+        step = 3
+    elif count <= 10:
+        step = 4
+    elif count <= 14:
+        step = 5
+    else:
+        step = 6
+    if party_size < 3:
+        step = step + 1
+    elif party_size >= 6:
+        step = step - 1
+    return ENCOUNTER_MULTIPLIERS[step]
+
+# Adjusted XP window for a difficulty, from its threshold up to the next one
+def xp_window(levels, difficulty):
+    i = DIFFICULTIES.index(difficulty)
+    low = sum(XP_THRESHOLDS[level][i] for level in levels)
+    if i + 1 < len(DIFFICULTIES):
+        high = sum(XP_THRESHOLDS[level][i + 1] for level in levels)
+    else:
+        high = low * 3 // 2
+    return low, high
+
+# Monster names by challenge rating for the ids, skipping unrollable hit dice
+def build_pools(ids, db):
+    pools = {}
+    cr = db.columns['cr_value']
+    for i in ids:
+        value = cr[i]
+        if value != value or value not in CR_XP:
+            continue
+        name = db.names[i]
+        try:
+            compile_roll(db[name]['roll'])
+        except (ValueError, KeyError, IndexError):
+            continue
+        pools.setdefault(value, []).append(name)
+    return pools
+
+# Best fitting (cr, count) groups by adjusted XP inside [low, high), searched
+# depth first from the highest XP. Adding monsters never lowers adjusted XP,
+# so a count that reaches high ends that branch
+def search_builds(crs, low, high, party_size, max_count, kinds, top):
+    values = sorted(((CR_XP[cr], cr) for cr in crs), reverse=True)
+    best = []
+    nodes = 0
+
+    def search(start, groups, count, raw):
+        nonlocal nodes
+        for i in range(start, len(values)):
+            xp, cr = values[i]
+            n = 1
+            while count + n <= max_count and nodes < BUILD_NODE_LIMIT:
+                nodes = nodes + 1
+                total = raw + xp * n
+                adjusted = total * encounter_multiplier(count + n, party_size)
+                if adjusted >= high:
+                    break
+                build = groups + [(cr, n)]
+                if adjusted >= low: # Closest above the threshold, then fewest monsters, the heap top is the worst kept
+                    entry = (low - adjusted, -(count + n), -nodes, adjusted, total, build)
+                    if len(best) < top:
+                        heapq.heappush(best, entry)
+                    elif entry > best[0]:
+                        heapq.heapreplace(best, entry)
+                if len(build) < kinds:
+                    search(i + 1, build, count + n, total)
+                n = n + 1
+
+    search(0, [], 0, 0)
+    best.sort(reverse=True)
+    return [entry[3:] for entry in best]
+
+# Generate encounters for the party at a difficulty, or add a generated one
+def build_encounter(fields, combatants, db, candidates):
+    try:
+        if len(fields) >= 2 and fields[1] == 'add':
+            if len(fields) > 3:
+                raise IndexError
+            n = int(fields[2]) if len(fields) == 3 else 1
+            if not 1 <= n <= len(candidates):
+                print(f'no build {n}, run build <difficulty> first')
+                return
+            for name, count in candidates[n - 1]:
+                dex_mod = db[name]['dex_mod']
+                ac = db[name]['ac']
+                e_type = db[name]['type']
+                print(f'adding {count} {name}(s), {db[name]["roll"]} HP:')
+                for health in roll_batch(db[name]['roll'], count):
+                    add_combatant(Combatant(name, dex_mod, health, ac, e_type), combatants)
+                    print(f'{name} : {dex_mod} DEX, {health} HP, {ac} AC, {e_type}')
+            return
+
+        difficulty = fields[1].lower()
+        if difficulty not in DIFFICULTIES:
+            raise IndexError
+        if not players_list:
+            print('no players in the encounter to build for')
+            return
+
+        levels = [1] * len(players_list)
+        max_count = 10
+        kinds = 3
+        top = 5
+        filters = []
+        i = 2
+        while i < len(fields):
+            key, value = fields[i].lower(), fields[i + 1]
+            if key == 'level':
+                levels = [int(value)] * len(players_list)
+            elif key == 'levels':
+                levels = [int(level) for level in value.split(',')]
+                if len(levels) != len(players_list):
+                    print(f'levels must list one level per player: {", ".join(players_list)}')
+                    return
+            elif key == 'max':
+                max_count = int(value)
+            elif key == 'kinds':
+                kinds = int(value)
+            elif key == 'top':
+                top = int(value)
+            else:
+                filters.append((key, value))
+            i = i + 2
+        if not all(level in XP_THRESHOLDS for level in levels) or min(max_count, kinds, top) < 1:
+            raise ValueError('out of range')
+
+        ids = db.query(filters) if filters else range(len(db))
+        pools = build_pools(ids, db)
+        low, high = xp_window(levels, difficulty)
+        builds = search_builds(pools, low, high, len(players_list), max_count, kinds, top)
+        if not builds:
+            print(f'no {difficulty} encounter found between {low} and {high} adjusted XP')
+            return
+
+        # A monster is picked for each challenge rating in a build
+        candidates.clear()
+        table = [['#', 'Monsters', 'Count', 'XP', 'Adjusted XP']]
+        for n, (adjusted, total, build) in enumerate(builds, 1):
+            picks = [(random.choice(pools[cr]), count) for cr, count in build]
+            candidates.append(picks)
+            monsters = ', '.join(f'{count}x {name}' for name, count in picks)
+            table.append([n, monsters, sum(count for name, count in picks), total, f'{adjusted:g}'])
+        print(f'{difficulty} for levels {", ".join(str(level) for level in levels)}: {low} to {high} adjusted XP')
+        print(tabulate.tabulate(table, headers='firstrow', tablefmt='simple'))
+        print('use build add <#> to add one')
+    except (IndexError, ValueError, KeyError):
+        print('usage: build <easy|medium|hard|deadly> [level <n>|levels <n,n,...>] [max <#>] [kinds <#>] [top <#>] [<monster field> <value> ...]\n\tbuild add [#]')
 
 # Print help for any command possible
 def print_help(command):
@@ -607,24 +2852,33 @@ def print_help(command):
         'rollall'   :   'rollall\n\treroll all combatant initiatives and reload\n\tusage: rollall',
         'clear'     :   'clear\n\tclear terminal\n\tusage: clear',
         'reload'    :   'reload\n\tclear terminal and sort combatants\n\tusage: reload',
-        'list'      :   'list\n\tlist saved encounters\n\tusage: list',
-        'save'      :   'save\n\tsave encounter to file\n\tusage: save <file> [-f]',
-        'load'      :   'load\n\tload encounter from file\n\tusage: load <file>',
-        'add'       :   'add\n\tadd combatants from database, file, or create custom\n\tusage:\tadd from file:\tadd <file>\n\t\tadd from db:\tadd <name> [#]\n\t\tadd custom:\tadd <name> <dex_mod> <hp> <ac> <type> [#]',
-        'remove'    :   'remove\n\tremove combatants from encounter by name, multiple can be combined\n\tusage: remove <name> [*]',
+        'list'      :   'list\n\tlist library encounters with their size, total CR, XP and tags\n\tusage: list [prefix] [tag <tag>]',
+        'save'      :   'save\n\tsave encounter to the library\n\tusage: save <name> [-f]',
+        'load'      :   'load\n\tload encounter from the library, or from data/<name>.json\n\tusage: load <name>',
+        'library'   :   'library\n\timport json encounters, export them, tag or delete them\n\tusage: library <import <file|dir> [...] [-f]|export <name> [file]|tag <name> <tag> [...]|untag <name> <tag> [...]|delete <name>>',
+        'add'       :   'add\n\tadd combatants from database, library, or create custom\n\tusage:\tadd from library:\tadd <name>\n\t\tadd from db:\tadd <name> [#]\n\t\tadd custom:\tadd <name> <dex_mod> <hp> <ac> <type> [#]',
+        'remove'    :   'remove\n\tremove combatants from encounter by name, multiple can be combined\n\tnames ending in * match as prefixes, a trailing * applies to every name\n\tusage: remove <name> [<name> ...] [*]',
         'edit'      :   'edit\n\tedit fields for a combatant\n\tusage: edit <name> <field> <value>\n\tfields: name, roll, hp, ac, dex, type',
-        'damage'    :   'damage\n\tdamage combatant\n\tusage: damage <name> <#>',
-        'heal'      :   'heal\n\theal combatant\n\tusage: heal <name> <#>',
+        'dice'      :   'dice\n\troll a dice expression, supports d, +, -, * and keep highest/lowest (4d6kh3, 2d20kl1)\n\tusage: dice <expression> [roll|average|max] [#]',
+        'damage'    :   'damage\n\tdamage combatants, names ending in * match as prefixes\n\tusage: damage <name> [<name> ...] <#>',
+        'heal'      :   'heal\n\theal combatants, names ending in * match as prefixes\n\tusage: heal <name> [<name> ...] <#>',
         'roll'      :   'roll\n\troll initiative for all players\n\tusage: roll',
-        'lock'      :   'lock\n\tlock initiative for a combatant\n\tusage: lock <name>',
+        'lock'      :   'lock\n\tlock initiative for combatants, names ending in * match as prefixes\n\tusage: lock <name> [<name> ...]',
         'help'      :   'help\n\tshow entire help screen\n\tusage:\tfull list:\thelp\n\t\tcommand only:\thelp [command]\n\t\tcommand list:\thelp commands',
         'hist'      :   'hist\n\tnavigate through command history\n\tusage: hist [print]',
-        'exit'      :   'exit\n\tsave and exit the program\n\tusage: exit',
+        'exit'      :   'exit\n\tsave and exit the program, detaches when attached to a daemon\n\tusage: exit',
         'shell'     :   'shell\n\texecute shell commands\n\tusage: shell <command>',
         'bash'      :   'bash\n\tstart a bash subprocess\n\tusage: bash',
+        'encounter' :   'encounter\n\tkeep several encounters open, new ones start with fresh rolls for the players\n\tusage: encounter [list|new <name>|switch <name>|close <name>]',
+        'next'      :   'next\n\tpass the turn to the next combatant, the last turn rolls a new round\n\tusage: next',
+        'prev'      :   'prev\n\tgive the turn back to the previous combatant\n\tusage: prev',
+        'build'     :   'build\n\tgenerate encounters for the players from the difficulty XP budget, filters are monster fields\n\tusage: build <easy|medium|hard|deadly> [level <n>|levels <n,n,...>] [max <#>] [kinds <#>] [top <#>] [<field> <value> ...]\n\t       build add [#]\n\texample: build hard level 5 type undead max 6',
+        'stats'     :   'stats\n\tshow p50, p95 and max time per command and startup phase, and allocated blocks\n\tusage: stats [reset]',
+        'profile'   :   'profile\n\tprofile commands with cProfile, hot spots are written to data/ when turned off\n\tusage: profile <on|off>',
+        'simulate'  :   'simulate\n\tmonte carlo simulate the current combat, reports win chance, rounds and player drop chances\n\tusage: simulate [trials] [level <party level>] [seed <seed>]',
         'sort'      :   'sort\n\tsort all combatants according to field\n\tusage: sort <name|roll|ac|type>',
-        'monster'   :   'monster\n\tsearch monster database by name or cr, multiple can be combined\n\tusage: monster <name|cr> <value>',
-        'spell'     :   'spell\n\tsearch spell database by class, level, name, school, and/or ritual\n\tusage: spell [class <class>] [classes] [level <level>] [school <school>] [schools] [ritual] [all]'
+        'monster'   :   'monster\n\tsearch monster database, multiple filters can be combined\n\tusage: monster <field> <value> [<field> <value> ...]\n\tfields: name, type, subtype, size, alignment, cr, ac, hp, str, dex, con, int, wis, cha, pb\n\tnumeric values: 5, 1/2, 2..5, ..5, >=15, <3\n\texample: monster cr 2..5 type undead size L ac >=15',
+        'spell'     :   'spell\n\tsearch spell database, filters are combined with and unless separated by or\n\tusage: spell [not] <filter> [[or] [not] <filter> ...]\n\tfilters: class <class>, level <level>, name <name>, school <school>, component <v|s|m>, text <words ...>, ritual, all\n\ttext matches descriptions containing every word, best matches first, its words run to the next filter\n\tfacets: classes, schools (counts within any other filters)\n\texample: spell class wizard level 3 not ritual or school necromancy\n\texample: spell text radiant damage class cleric'
     }
 
     command_list = list(usage_dict.keys())
@@ -650,9 +2904,9 @@ def sort_combatants(fields, combatants):
         if fields[1].lower() == 'name':
             combatants.sort(key=lambda c : c.name)
         elif fields[1].lower() == 'roll':
-            combatants.sort(key=lambda c : int(c.roll), reverse=True)
+            combatants.sort_initiative()
         elif fields[1].lower() == 'ac':
-            combatants.sort(key=lambda c : int(c.ac), reverse=True)
+            combatants.sort(key=operator.attrgetter('ac'), reverse=True)
         elif fields[1].lower() == 'type':
             combatants.sort(key=lambda c : c.type)
         else:
@@ -663,59 +2917,28 @@ def sort_combatants(fields, combatants):
 # Query db and show results in table
 def search_monsters(fields, db):
     try:
-        if len(fields) < 3:
+        if len(fields) < 3 or len(fields) % 2 == 0:
             raise Exception('improper usage')
 
-        matches = []
-        remove_buffer = []
-        skip = False
-        for i in range(len(fields)):
-            if skip:
-                skip = False
-                continue
-
-            f = fields[i]
-
-            if len(matches) != 0:
-                if f.lower() == 'name':
-                    for name,cr in matches:
-                        if not name.lower().find(fields[i + 1].lower()) != -1:
-                            remove_buffer.append((name, cr))
-                            skip = True
-                elif f.lower() == 'cr':
-                    for name,cr in matches:
-                        if cr != fields[i + 1]:
-                            remove_buffer.append((name, cr))
-                            skip = True
-                for e in remove_buffer:
-                    matches.remove(e)
-            else:
-                if f.lower() == 'name':
-                    for name in db:
-                        if name.lower().find(fields[i + 1].lower()) != -1:
-                            matches.append((name, db[name]['cr']))
-                            skip = True
-                elif f.lower() == 'cr':
-                    for name in db:
-                        if db[name]['cr'] == fields[i + 1]:
-                            matches.append((name, db[name]['cr']))
-                            skip = True
-
-        matches.sort(key = lambda m : float(m[1]))
+        # Pair up fields and values, every filter must match
+        filters = []
+        for i in range(1, len(fields), 2):
+            filters.append((fields[i].lower(), fields[i + 1]))
+        matches = db.query(filters)
 
         # Print only if matches found
         if len(matches) != 0:
             # Set table columns
-            table = [['Name', 'Health', 'AC', 'DEX', 'Type', 'CR']]
+            table = [['Name', 'Health', 'AC', 'DEX', 'Type', 'Size', 'CR']]
+            columns = db.columns
             
             # Add each match to the table
-            for m in matches:
-                c = db[m[0]]
-                if c['dex_mod'] >= 0:
-                    init = f'+{c["dex_mod"]}'
+            for i in matches:
+                if columns['dex_mod'][i] >= 0:
+                    init = f'+{columns["dex_mod"][i]}'
                 else:
-                    init = c['dex_mod']
-                table.append([m[0], c['roll'], c['ac'], init, c['type'], c['cr']])
+                    init = columns['dex_mod'][i]
+                table.append([db.names[i], columns['roll'][i], columns['ac'][i], init, columns['type'][i], columns['size'][i], columns['cr'][i]])
 
             # Draw the table
             print(tabulate.tabulate(
@@ -726,239 +2949,161 @@ def search_monsters(fields, db):
             ))
         else:
             print('no matches')
+            for field, value in filters:
+                if field == 'name' and not db.find(value):
+                    print_suggestions(db.suggest(value))
     except:
-        print('usage: monster <name|cr> <value>')
+        print('usage: monster <field> <value> [<field> <value> ...]\n'
+              'fields: name, type, subtype, size, alignment, cr, ac, hp, str, dex, con, int, wis, cha, pb\n'
+              'numeric values: 5, 1/2, 2..5, ..5, >=15, <3')
+
+# Word wrap a spell into its attribute and description table cells
+def render_spell_card(m, description_width=71):
+    description = m['description']
+    if 'higher_levels' in m:
+        description = m['description'] + f'\n\n{m["higher_levels"]}'
+
+    # Parse Description
+    line_length = description_width
+    lines = ['']
+    words = description.split(' ')
+
+    first = True
+    for word in words:
+        if word.find('\n') != -1:
+            parts = word.split('\n')
+
+            # Append first one or make new line
+            if len(lines[-1]) + len(parts[0]) + 1 >= line_length:
+                lines.append(parts[0])
+            else:
+                lines[-1] = f'{lines[-1]} {parts[0]}'
+
+            # Make new lines for all others
+            for i in range(len(parts) - 1):
+                lines.append(parts[i + 1])
+        elif len(lines[-1]) + len(word) + 1 >= line_length or first:
+            first = False
+            lines.append(word) # Start a new line
+        else:
+            lines[-1] = f'{lines[-1]} {word}' # Append to the last line
+
+    final_description = '\n'.join(lines)
+
+    # Parse Attributes
+    title = m['name']
+
+    school = m['school']
+    school = school[0].upper() + school[1:]
+
+    level = f"Level {m['level']}, {school}"
+    if m['level'] == 'cantrip':
+        level = f'Cantrip, {school}'
+
+    # Parse Casting Time
+    time = m['casting_time']
+    requirement = m['casting_time']
+    casting_time = ''
+    if time.find(',') != -1:
+        casting_time = time.split(', ')[0]
+        requirement = ' '.join(time.split(', ')[1:])
+        requirement = requirement[0].upper() + requirement[1:]
+
+        # Parse Requirement
+        line_length = 30
+        lines = ['']
+        words = requirement.split(' ')
+
+        first = True
+        for word in words:
+            if len(lines[-1]) + len(word) + 1 >= line_length or first:
+                first = False
+                lines.append(word)
+            else:
+                lines[-1] = f'{lines[-1]} {word}'
 
-def search_spells(fields, db): # TODO: comment
-    try:
-        if len(fields) < 2:
-            raise Exception('improper usage')
+        requirement = '\n'.join(lines)                                        
 
-        matches = []
-        remove_buffer = []
-        skip = False
+    time = f'Casting Time: {casting_time}{requirement}'
 
-        for i in range(len(fields)):
-            if skip:
-                skip = False
-                continue
+    # Ritual Tag
+    ritual = 'Ritual: '
+    if m['ritual']:
+        ritual = ritual + 'Yes'
+    else:
+        ritual = ritual + 'No'
 
-            f = fields[i]
-
-            if len(matches) != 0:
-                if f.lower() == 'class':
-                    for spell in matches:
-                        found = False
-                        for player_class in spell['classes']:
-                            if player_class.lower().find(fields[i + 1].lower()) != -1:
-                                found = True
-                        if not found:
-                            remove_buffer.append(spell)
-                            skip = True
-                elif f.lower() == 'classes':
-                    print('Bard, Cleric\nDruid, Paladin\nRanger, Sorcerer\nWarlock, Wizard')
-                    return
-                elif f.lower() == 'level':
-                    for spell in matches:
-                        if spell['level'] != fields[i + 1]:
-                            remove_buffer.append(spell)
-                            skip = True
-                elif f.lower() == 'name':
-                    name = fields[i + 1].lower().replace('_', ' ').lower()
-                    for spell in matches:
-                        if spell['name'].lower().find(name) == -1:
-                            remove_buffer.append(spell)
-                            skip = True                        
-                elif f.lower() == 'school':
-                    for spell in matches:
-                        if spell['school'].lower().find(fields[i + 1].lower()) == -1:
-                            remove_buffer.append(spell)
-                            skip = True
-                elif f.lower() == 'schools':
-                    print('Conjuration\nNecromancy\nEvocation\nAbjuration\nTransmutation\nDivination\nEnchantment\nIllusion')
-                    return
-                elif f.lower() == 'ritual':
-                    for spell in matches:
-                        if not spell['ritual']:
-                            remove_buffer.append(spell)
-                elif f.lower() == 'all':
-                    matches = []
-                    for entry in db:
-                        matches.append(db[entry])
-                    break
-                for e in remove_buffer:
-                    if e in matches:
-                        matches.remove(e)
-            else:
-                if f.lower() == 'class':
-                    for entry in db:
-                        spell = db[entry]
-                        for player_class in spell['classes']:
-                            if player_class.lower().find(fields[i + 1].lower()) != -1:
-                                matches.append(spell)
-                                skip = True
-                elif f.lower() == 'classes':
-                    print('Bard, Cleric\nDruid, Paladin\nRanger, Sorcerer\nWarlock, Wizard')
-                    return
-                elif f.lower() == 'level':
-                    for entry in db:
-                        spell = db[entry]
-                        if spell['level'] == fields[i + 1]:
-                            matches.append(spell)
-                            skip = True
-                elif f.lower() == 'name':
-                    name = fields[i + 1].lower().replace('_', ' ').lower()
-                    for entry in db:
-                        spell = db[entry]
-                        if spell['name'].lower().find(name) != -1:
-                            matches.append(spell)
-                            skip = True
-                elif f.lower() == 'school':
-                    for entry in db:
-                        spell = db[entry]
-                        if spell['school'].lower().find(fields[i + 1].lower()) != -1:
-                            matches.append(spell)
-                            skip = True
-                elif f.lower() == 'schools':
-                    print('Conjuration, Necromancy\nEvocation, Abjuration\nTransmutation, Divination\nEnchantment, Illusion')
-                    return
-                elif f.lower() == 'ritual':
-                    for entry in db:
-                        spell = db[entry]
-                        if spell['ritual']:
-                            matches.append(spell)
-                elif f.lower() == 'all':
-                    for entry in db:
-                        matches.append(db[entry])
-                    break
-        
-        if len(matches) != 0:
-            table = [['Attributes', 'Description']]
-            for m in matches:
-                description = m['description']
-                if 'higher_levels' in m:
-                    description = m['description'] + f'\n\n{m["higher_levels"]}'
-
-                # Parse Description
-                line_length = 71
-                lines = ['']
-                words = description.split(' ')
-
-                first = True
-                for word in words:
-                    if word.find('\n') != -1:
-                        parts = word.split('\n')
-
-                        # Append first one or make new line
-                        if len(lines[-1]) + len(parts[0]) + 1 >= line_length:
-                            lines.append(parts[0])
-                        else:
-                            lines[-1] = f'{lines[-1]} {parts[0]}'
-                        
-                        # Make new lines for all others
-                        for i in range(len(parts) - 1):
-                            lines.append(parts[i + 1])
-                    elif len(lines[-1]) + len(word) + 1 >= line_length or first:
-                        first = False
-                        lines.append(word) # Start a new line
-                    else:
-                        lines[-1] = f'{lines[-1]} {word}' # Append to the last line
-
-                final_description = '\n'.join(lines)
-
-                # Parse Attributes
-                title = m['name']
-
-                school = m['school']
-                school = school[0].upper() + school[1:]
-
-                level = f"Level {m['level']}, {school}"
-                if m['level'] == 'cantrip':
-                    level = f'Cantrip, {school}'
-
-                # Parse Casting Time
-                time = m['casting_time']
-                requirement = m['casting_time']
-                casting_time = ''
-                if time.find(',') != -1:
-                    casting_time = time.split(', ')[0]
-                    requirement = ' '.join(time.split(', ')[1:])
-                    requirement = requirement[0].upper() + requirement[1:]
-
-                    # Parse Requirement
-                    line_length = 30
-                    lines = ['']
-                    words = requirement.split(' ')
-
-                    first = True
-                    for word in words:
-                        if len(lines[-1]) + len(word) + 1 >= line_length or first:
-                            first = False
-                            lines.append(word)
-                        else:
-                            lines[-1] = f'{lines[-1]} {word}'
-
-                    requirement = '\n'.join(lines)                                        
-
-                time = f'Casting Time: {casting_time}{requirement}'
-
-                # Ritual Tag
-                ritual = 'Ritual: '
-                if m['ritual']:
-                    ritual = ritual + 'Yes'
-                else:
-                    ritual = ritual + 'No'
+    spell_range = f"Range: {m['range']}"
+
+    verbal = m['components']['verbal']
+    somatic = m['components']['somatic']
+    material = m['components']['material']
+
+    components = 'Components: '
+    if verbal:
+        components = components + 'V'
+    if somatic:
+        if verbal:
+            components = components + ', S'
+        else:
+            components = components + 'S'
+    if material:
+        if verbal or somatic:
+            components = components + ', M'
+        else:
+            components = components + 'M'
 
-                spell_range = f"Range: {m['range']}"
+    duration = f"Duration: {m['duration']}"
 
-                verbal = m['components']['verbal']
-                somatic = m['components']['somatic']
-                material = m['components']['material']
+    classes = []
+    for c in m['classes']:
+        classes.append(c[0].upper() + c[1:])
 
-                components = 'Components: '
-                if verbal:
-                    components = components + 'V'
-                if somatic:
-                    if verbal:
-                        components = components + ', S'
-                    else:
-                        components = components + 'S'
-                if material:
-                    if verbal or somatic:
-                        components = components + ', M'
-                    else:
-                        components = components + 'M'
+    lines = []
+    for i in range(0, len(classes), 2):
+        lines.append(', '.join(classes[i:i + 2]))
 
-                duration = f"Duration: {m['duration']}"
+    classes_joined = '\n'.join(lines)
+    classes_string = f"Classes: {classes_joined}"
 
-                classes = []
-                for c in m['classes']:
-                    classes.append(c[0].upper() + c[1:])
+    attributes = f'{title}\n{level}\n\n{ritual}\n{time}\n\n{spell_range}\n{components}\n{duration}\n\n{classes_string}'
 
-                lines = []
-                for i in range(0, len(classes), 2):
-                    lines.append(', '.join(classes[i:i + 2]))
+    return attributes, final_description
 
-                classes_joined = '\n'.join(lines)
-                classes_string = f"Classes: {classes_joined}"
+# Search spells through the store's bitset index and show results in table
+def search_spells(fields, db):
+    try:
+        if len(fields) < 2:
+            raise Exception('improper usage')
 
-                attributes = f'{title}\n{level}\n\n{ritual}\n{time}\n\n{spell_range}\n{components}\n{duration}\n\n{classes_string}'
+        bits, facets, scores = db.select(fields[1:])
 
-                table.append([attributes, final_description])
+        # Facet listings show counts within the other filters
+        if facets:
+            for facet in facets:
+                counts = db.facet_counts(facet, bits)
+                for value in sorted(counts):
+                    print(f'{value[0].upper() + value[1:]}: {counts[value]}')
+            return
 
-            print(tabulate.tabulate(
-                table,
-                headers='firstrow',
-                tablefmt='fancy_grid',
-                stralign='left'
-            ))
+        matches = db.names(bits)
+        if scores: # Best text matches first, ties keep index order
+            matches.sort(key=lambda name : -scores.get(db.positions[name], 0))
 
-            print(f'{len(table) - 1} Result(s)')
+        if len(matches) != 0:
+            width = shutil.get_terminal_size((120, 40)).columns
+            print(db.table(matches, width))
+            print(f'{len(matches)} Result(s)')
         else:
             print('No Results')
+            for i in range(1, len(fields) - 1):
+                if fields[i].lower() == 'name' and not db.name_index.find(fields[i + 1].replace('_', ' ')):
+                    print_suggestions(db.suggest(fields[i + 1]))
             raise Exception('empty results')
     except:
-        print('usage: spell [class <class>] [classes] [level <level>] [school <school>] [schools] [ritual] [all]')
+        print('usage: spell [not] <filter> [[or] [not] <filter> ...]\n'
+              'filters: class <class>, level <level>, name <name>, school <school>, component <v|s|m>, text <words ...>, ritual, all\n'
+              'facets: classes, schools')
 
 def manage_spellbook(fields, db): # TODO: implement
     # usage: <spellbook|sb> <name> [add|remove] <title>
@@ -971,129 +3116,1006 @@ def manage_spellbook(fields, db): # TODO: implement
     except:
         print('problem')
 
-# Main entrypoint
-def main():
-    # Populate databases
-    monster_db = {}
-    populate_monsters('data/monsters.csv', monster_db)
-    spell_db = {}
-    populate_spells('data/spells.json', spell_db)
-
-    # Start empty lists for hist and combatants
-    hist = []
-    combatants = []
+# Nearest rank percentile of sorted values
+def percentile(values, p):
+    return values[max(0, math.ceil(p * len(values)) - 1)]
+
+# Wall time and allocation samples for every dispatched command and startup phase
+class CommandStats:
+    def __init__(self):
+        self.times = {}
+        self.blocks = {}
+        self.peaks = {}
+        self.last = 0
+
+    # Call fn and record it under name, returns its result
+    def record(self, name, fn, *args):
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        blocks = sys.getallocatedblocks()
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.last = time.perf_counter() - start
+            self.times.setdefault(name, []).append(self.last)
+            self.blocks.setdefault(name, []).append(sys.getallocatedblocks() - blocks)
+            if tracing:
+                self.peaks.setdefault(name, []).append(tracemalloc.get_traced_memory()[1] - base)
+
+    # Forget all samples
+    def clear(self):
+        self.times.clear()
+        self.blocks.clear()
+        self.peaks.clear()
+
+    # Print count, p50, p95, max time and mean allocation per command
+    def report(self, stream=None):
+        if not self.times:
+            print('no commands recorded', file=stream)
+            return
 
-    # Populate default combatants
+        headers = ['Command', 'Count', 'p50 ms', 'p95 ms', 'Max ms', 'Total ms', 'Blocks +/-']
+        if self.peaks:
+            headers.append('Peak KB')
+        table = [headers]
+        for name in sorted(self.times):
+            times = sorted(self.times[name])
+            blocks = self.blocks[name]
+            row = [name, len(times), f'{percentile(times, 0.5) * 1000:.3f}', f'{percentile(times, 0.95) * 1000:.3f}',
+                f'{times[-1] * 1000:.3f}', f'{sum(times) * 1000:.3f}', round(sum(blocks) / len(blocks))]
+            if self.peaks:
+                peaks = self.peaks.get(name)
+                row.append(f'{max(peaks) / 1024:.1f}' if peaks else '-')
+            table.append(row)
+        print(tabulate.tabulate(table, headers='firstrow', tablefmt='simple'), file=stream)
+
+# Named encounters kept in memory, every encounter shares the players_list roster
+# and keeps its own rows, so rolls, locks and the round counter stay separate
+class Session:
+    def __init__(self):
+        self.encounters = {'main' : Encounter()}
+        self.active = 'main'
+        self.candidates = [] # Builds listed by the last build, for build add
+
+    @property
+    def current(self):
+        return self.encounters[self.active]
+
+    # New encounter with initiative rows for the players in the current one,
+    # the rows share each player's record and roll on their own
+    def create(self, name):
+        combatants = Encounter()
+        for p in players_list:
+            for c in self.current.find(p):
+                player = PlayerView(player_record(c))
+                player.reroll()
+                add_combatant(player, combatants)
+        combatants.sort_initiative()
+        self.encounters[name] = combatants
+        self.active = name
+
+    # Move a player's rows in the other encounters after its shared DEX changed
+    def reorder(self, c):
+        record = player_record(c)
+        for combatants in self.encounters.values():
+            if combatants is self.current:
+                continue
+            for other in combatants.find(c.name):
+                if player_record(other) is record:
+                    combatants.update(other, 'init_mod', c.init_mod)
+
+    def switch(self, name):
+        if name not in self.encounters:
+            raise KeyError(name)
+        self.active = name
+
+    # Drop an encounter, closing the active one switches to the last opened
+    def close(self, name):
+        del self.encounters[name]
+        if name == self.active:
+            self.active = list(self.encounters)[-1]
+
+# Create, switch, list and close encounters, returns True when the table changed
+def manage_encounters(fields, session):
     try:
-        load_json('autosave', combatants, monster_db)
-        print('loaded autosave...')
-    except:
-        load_json('players', combatants, monster_db)
-        print('autosave error, loading default...')
+        action = fields[1] if len(fields) > 1 else 'list'
+        if action == 'list' and len(fields) <= 2:
+            table = [['', 'Encounter', 'Combatants', 'Round', 'Locked']]
+            for name, combatants in session.encounters.items():
+                active = '*' if name == session.active else ''
+                table.append([active, name, len(combatants), combatants.round, sum(1 for c in combatants if c.locked)])
+            print(tabulate.tabulate(table, headers='firstrow', tablefmt='simple'))
+            return False
+
+        name = fields[2]
+        if len(fields) != 3:
+            raise IndexError
+        if action == 'new':
+            if name in session.encounters:
+                print(f'encounter {name} already exists')
+                return False
+            session.create(name)
+            print(f'created encounter {name}')
+        elif action == 'switch':
+            if name not in session.encounters:
+                print(f'encounter {name} cannot be found')
+                return False
+            session.switch(name)
+        elif action == 'close':
+            if name not in session.encounters:
+                print(f'encounter {name} cannot be found')
+                return False
+            if len(session.encounters) == 1:
+                print('cannot close the only encounter')
+                return False
+            session.close(name)
+            print(f'closed encounter {name}, now in {session.active}')
+        else:
+            raise IndexError
+        return True
+    except IndexError:
+        print('usage: encounter [list|new <name>|switch <name>|close <name>]')
+        return False
+
+# Commands that change encounter state and are written to the journal, bare
+# roll prompts for its rolls and is journaled with them inline
+JOURNAL_COMMANDS = ('rollall', 'reroll', 'reload', 'load', 'add', 'remove', 'edit',
+    'damage', 'heal', 'roll ', 'lock', 'sort', 'encounter', 'next', 'prev', 'build')
+
+# Journaled commands between snapshots
+SNAPSHOT_INTERVAL = 200
+
+# Every open encounter, its rows and the player roster as plain data
+def session_state(session):
+    return {
+        'active' : session.active,
+        'players' : list(players_list),
+        'candidates' : list(session.candidates),
+        'encounters' : {name : {'round' : combatants.round, 'turn' : combatants.turn, 'ordered' : combatants.ordered,
+            'combatants' : encounter_state(combatants), 'joined' : [c.joined for c in combatants]}
+            for name, combatants in session.encounters.items()}
+    }
 
-    # Primary loop
-    while(True):
-        os.system('clear')
-        draw_all(combatants)
-        hist_command = ''
+# Rebuild a session from session_state, names are kept as saved
+def restore_session(session, state):
+    players_list[:] = sorted(state['players'])
+    session.encounters = {}
+    records = {} # Player rows after the first share its record
+    for name, saved in state['encounters'].items():
+        combatants = Encounter()
+        for row in saved['combatants']:
+            if row['name'] in records:
+                c = PlayerView(records[row['name']])
+            else:
+                c = Combatant(row['name'], row['init_mod'], row['health'], row['ac'], row['type'])
+                if row['name'] in players_list:
+                    records[row['name']] = c
+            c.roll = row['roll']
+            c.locked = row['locked']
+            combatants.append(c)
+        if 'joined' in saved: # Keep initiative ties in join order
+            for c, joined in zip(combatants, saved['joined']):
+                c.joined = joined
+            combatants.joins = max(saved['joined'], default=-1) + 1
+        combatants.round = saved['round']
+        combatants.turn = saved.get('turn', 0)
+        combatants.ordered = saved.get('ordered', False)
+        session.encounters[name] = combatants
+    session.active = state['active']
+    session.candidates = state.get('candidates', [])
+
+# Write-ahead journal of state changing commands in segments under data/, each
+# entry keeps the seed its command ran under so replay rolls the same numbers.
+# Every SNAPSHOT_INTERVAL entries a new segment is started and the session is
+# snapshotted in the background, after which older segments are deleted
+class Journal:
+    def __init__(self, directory='data'):
+        self.directory = directory
+        self.snapshot_path = os.path.join(directory, 'session.snapshot')
+        self.seq = 0
+        self.pending = 0
+        self.file = None
+        self.writer = None
+        self.lock_file = None
+
+    def accepts(self, buffer):
+        return buffer.startswith(JOURNAL_COMMANDS)
+
+    # Take the journal for this process, False if another tracker holds it
+    def acquire(self):
+        self.lock_file = open(os.path.join(self.directory, 'journal.lock'), 'a')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            self.lock_file.close()
+            self.lock_file = None
+            return False
+
+    # Segment files as (first seq, path) in order
+    def segments(self):
+        found = []
+        for file in os.listdir(self.directory):
+            parts = file.split('.')
+            if len(parts) == 3 and parts[0] == 'journal' and parts[1].isnumeric() and parts[2] == 'log':
+                found.append((int(parts[1]), os.path.join(self.directory, file)))
+        return sorted(found)
+
+    # Last snapshot and the entries written after it, None when there is neither
+    def recover(self):
+        state = None
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path) as f:
+                state = json.load(f)
+        base = state['seq'] if state else 0
+
+        entries = []
+        for start, path in self.segments():
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError: # Torn final write
+                        break
+                    if entry['seq'] > base:
+                        entries.append(entry)
+        if state is None and not entries:
+            return None
+
+        self.seq = entries[-1]['seq'] if entries else base
+        return state, entries
+
+    # Seed random for a command and return the seed to journal
+    def reseed(self):
+        seed = int.from_bytes(os.urandom(8), 'little')
+        random.seed(seed)
+        return seed
+
+    # Start a segment for the entries after seq
+    def open(self):
+        if self.file:
+            self.file.close()
+        path = os.path.join(self.directory, f'journal.{self.seq + 1}.log')
+        self.file = open(path, 'a')
+
+    # Append an entry, flushed to the OS so it survives the process dying
+    def append(self, command, seed):
+        self.seq = self.seq + 1
+        self.pending = self.pending + 1
+        self.file.write(json.dumps({'seq' : self.seq, 'seed' : seed, 'command' : command}) + '\n')
+        self.file.flush()
+
+    def due(self):
+        return self.pending >= SNAPSHOT_INTERVAL
+
+    # Snapshot state as of the current seq, in the background unless wait
+    def compact(self, state, wait=False):
+        self.join()
+        state['seq'] = self.seq
+        data = json.dumps(state).encode()
+        self.pending = 0
+        self.open()
+        self.writer = threading.Thread(target=self.write_snapshot, args=(data, state['seq']))
+        self.writer.start()
+        if wait:
+            self.join()
+
+    def write_snapshot(self, data, seq):
+        try:
+            write_atomic(self.snapshot_path, data, True)
+            for start, path in self.segments():
+                if start <= seq:
+                    os.remove(path)
+        except OSError: # Entries stay in the journal until the next snapshot
+            pass
+
+    def join(self):
+        if self.writer:
+            self.writer.join()
+            self.writer = None
+
+    # Clean exit, autosave.json holds the state from here on so the snapshot
+    # and segments are removed and the next start loads it
+    def retire(self):
+        self.join()
+        if self.file:
+            self.file.close()
+            self.file = None
+        for start, path in self.segments():
+            os.remove(path)
+        if os.path.exists(self.snapshot_path):
+            os.remove(self.snapshot_path)
+
+# Messages a slow viewer may fall behind by before it is resynced
+SERVER_QUEUE_LIMIT = 256
+
+# Split [host:]port, the host defaults to localhost
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+# Read-only viewers of the initiative table over TCP as newline delimited json.
+# Viewers get a snapshot of the table rows on connect, then diffs of the rows
+# set, removed and reordered by name. The GM thread only copies the rows out,
+# diffing and fan out run on the server's own event loop thread
+class TableServer:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self.clients = set()
+        self.rows = {}
+        self.order = []
+        self.meta = {}
+        self.seq = 0
+        self.ready = threading.Event()
+        self.error = None
+
+    # Serve on a daemon thread, raises if the address cannot be bound
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        self.ready.wait()
+        if self.error:
+            raise self.error
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            server = self.loop.run_until_complete(asyncio.start_server(self.handle, self.host, self.port))
+        except OSError as e:
+            self.error = e
+            self.ready.set()
+            return
+        self.port = server.sockets[0].getsockname()[1]
+        self.ready.set()
+        self.loop.run_forever()
+
+    # Called from the GM thread after a command
+    def publish(self, combatants, encounter):
+        rows = [combatant_row(c) for c in combatants]
+        turn = combatants.marked_turn()
+        meta = {'encounter' : encounter, 'round' : combatants.round, 'turn' : None if turn is None else rows[turn][0]}
+        self.loop.call_soon_threadsafe(self.update, rows, meta)
+
+    def snapshot(self):
+        message = {'type' : 'snapshot', 'seq' : self.seq, 'columns' : TABLE_COLUMNS,
+            'rows' : [self.rows[name] for name in self.order]}
+        message.update(self.meta)
+        return (json.dumps(message) + '\n').encode()
+
+    # Diff rows against the last published table and broadcast the changes
+    def update(self, rows, meta):
+        order = [row[0] for row in rows]
+        current = {row[0] : row for row in rows}
+        self.seq = self.seq + 1
+        if len(current) != len(rows): # Duplicate names cannot be diffed by name
+            self.rows, self.order, self.meta = current, order, meta
+            self.broadcast(self.snapshot())
+            return
 
-        # Command loop
-        while(True):
-            if hist_command:
-                buffer = hist_command
-                hist_command = ''
+        message = {'type' : 'diff', 'seq' : self.seq}
+        changed = {name : row for name, row in current.items() if self.rows.get(name) != row}
+        removed = [name for name in self.order if name not in current]
+        if changed:
+            message['set'] = changed
+        if removed:
+            message['remove'] = removed
+        if order != self.order:
+            message['order'] = order
+        if meta != self.meta:
+            message.update(meta)
+        self.rows, self.order, self.meta = current, order, meta
+
+        if len(message) == 2: # Nothing visible changed
+            self.seq = self.seq - 1
+            return
+        self.broadcast((json.dumps(message) + '\n').encode())
+
+    # Queue a message for every viewer, one that fell too far behind is resynced
+    def broadcast(self, data):
+        for queue in self.clients:
+            if queue.full():
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(self.snapshot())
             else:
-                buffer = input('~$ ')
+                queue.put_nowait(data)
 
-            # Buffer command and split into fields
-            command_fields = buffer.split(' ')
-            if not buffer.startswith('hist'):
-                hist.append(buffer)
+    async def handle(self, reader, writer):
+        queue = asyncio.Queue(SERVER_QUEUE_LIMIT)
+        queue.put_nowait(self.snapshot())
+        self.clients.add(queue)
+        closed = asyncio.ensure_future(self.ignore(reader))
+        try:
+            while True:
+                message = asyncio.ensure_future(queue.get())
+                await asyncio.wait((message, closed), return_when=asyncio.FIRST_COMPLETED)
+                if closed.done():
+                    message.cancel()
+                    break
+                writer.write(message.result())
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.clients.discard(queue)
+            closed.cancel()
+            writer.close()
 
-            # Parse and execute commands
-            if buffer == '': # Accept empty command
-                continue
+    # Viewers are read-only, anything they send is dropped until they disconnect
+    async def ignore(self, reader):
+        try:
+            while await reader.read(4096):
+                pass
+        except (ConnectionError, OSError):
+            pass
+
+# Follow a tracker served with --serve and redraw its table on every update
+def watch_table(address):
+    rows = {}
+    order = []
+    meta = {'encounter' : '', 'round' : 0, 'turn' : None}
+    try:
+        with socket.create_connection(parse_address(address)) as sock:
+            for line in sock.makefile('r'):
+                message = json.loads(line)
+                if message['type'] == 'snapshot':
+                    rows = {row[0] : row for row in message['rows']}
+                    order = list(rows)
+                else:
+                    rows.update(message.get('set', {}))
+                    for name in message.get('remove', ()):
+                        rows.pop(name, None)
+                    order = message.get('order', [name for name in order if name in rows])
+                for key in meta:
+                    meta[key] = message.get(key, meta[key])
+
+                if sys.stdout.isatty():
+                    print('\x1b[H\x1b[2J', end='')
+                print(f'{meta["encounter"]} round {meta["round"]}')
+                draw_rows([rows[name] for name in order], order.index(meta['turn']) if meta['turn'] in rows else None)
+                sys.stdout.flush()
+        print('server closed the connection')
+    except (OSError, ValueError) as e:
+        print(f'cannot watch {address}: {e}')
+
+# Resident tracker behind a Unix socket, keeps the catalogs and encounters loaded
+# between attached clients. Requests are json lines run one at a time with
+# stdout captured, the reply carries the output and the table when it changed
+class TrackerDaemon:
+    def __init__(self, tracker, path=DAEMON_SOCKET):
+        self.tracker = tracker
+        self.path = path
+        self.lock = threading.Lock()
+        self.listener = None
+        self.stopping = False
+
+    # Accept clients until stopped, one thread per attached client
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            try:
+                connect_daemon(self.path).close()
+                raise RuntimeError(f'a daemon is already running on {self.path}')
+            except OSError: # Left behind by a daemon that died
+                os.remove(self.path)
+
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self.listener.listen()
+        print(f'daemon listening on {self.path}...')
+        try:
+            while not self.stopping:
+                try:
+                    conn, _ = self.listener.accept()
+                except OSError:
+                    break
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+        finally:
+            self.listener.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def handle(self, conn):
+        with conn:
+            stream = conn.makefile('rw')
+            try:
+                for line in stream:
+                    stream.write(json.dumps(self.run(json.loads(line))) + '\n')
+                    stream.flush()
+                    if self.stopping: # Wake the accept loop so it sees the stop
+                        connect_daemon(self.path).close()
+                        return
+            except (OSError, ValueError): # Client went away
+                pass
+
+    def run(self, request):
+        command = request.get('command')
+        output = io.StringIO()
+        redraw = command is None
+        with self.lock, contextlib.redirect_stdout(output):
+            if command is None:
+                pass
+            elif request.get('stop'): # Save, snapshot and shut the daemon down
+                self.stopping = True
+                try:
+                    self.tracker.dispatch('exit')
+                except SystemExit:
+                    pass
+            elif command.startswith('exit') or command.startswith('detach'): # State stays in the daemon
+                print('the daemon keeps running, stop it with --stop-daemon')
+            elif command == 'roll': # No terminal to prompt on
+                print('order: ' + ', '.join(players_list))
+                print('usage: roll <one roll per player>')
+            elif command == 'hist':
+                print('hist navigation needs a terminal, use hist print')
+            else:
+                redraw = self.tracker.dispatch(command)
+
+            reply = {'output' : output.getvalue()}
+            if request.get('draw') and redraw:
+                table = io.StringIO()
+                with contextlib.redirect_stdout(table):
+                    draw_all(self.tracker.combatants)
+                reply['table'] = table.getvalue()
+        return reply
+
+# Databases, encounters and history shared by the interactive and headless loops
+class Tracker:
+    def __init__(self, profile=False, journaled=True):
+        self.monster_db = MonsterDB()
+        self.spell_db = SpellStore()
+        self.session = Session()
+        self.hist = []
+        self.renderer = None
+        self.stats = CommandStats()
+        self.profiler = None
+        self.journal = Journal() if journaled else None
+        self.server = None
+
+        # Allocation peaks and hot spots from the first startup phase on
+        if profile:
+            tracemalloc.start()
+            self.start_profile()
+
+    @property
+    def combatants(self):
+        return self.session.current
+
+    # Populate databases and default combatants, each phase is recorded
+    def startup(self):
+        profiler = self.profiler
+        if profiler:
+            profiler.enable()
+        try:
+            self.stats.record('startup:monsters', populate_monsters, 'data/monsters.csv', self.monster_db)
+            self.stats.record('startup:spells', populate_spells, 'data/spells.json', self.spell_db)
+            self.stats.record('startup:library', self.migrate_library)
+            if not self.journal:
+                self.stats.record('startup:autosave', self.load_autosave)
+                return
+
+            owned = self.journal.acquire()
+            if not self.stats.record('startup:journal', self.replay_journal):
+                self.stats.record('startup:autosave', self.load_autosave)
+
+            # Snapshot the starting state, the journal holds what comes after it
+            if owned:
+                self.journal.compact(session_state(self.session))
+            else:
+                print('journal is held by another tracker, changes here are not journaled...')
+                self.journal = None
+        finally:
+            if profiler:
+                profiler.disable()
 
-            elif buffer.startswith('rollall') or buffer.startswith('reroll'): # Reroll combat round
-                advance_round(combatants)
-                break
+    # Restore the last snapshot and replay the journal after it, False if there is none
+    def replay_journal(self):
+        try:
+            recovered = self.journal.recover()
+        except (OSError, ValueError, KeyError):
+            print('journal unreadable, loading autosave...')
+            return False
+        if not recovered:
+            return False
+
+        state, entries = recovered
+        journal = self.journal
+        self.journal = None # Replayed commands are already journaled
+        skipped = []
+        try:
+            if state:
+                restore_session(self.session, state)
+            with contextlib.redirect_stdout(io.StringIO()):
+                for entry in entries:
+                    random.seed(entry['seed'])
+                    try:
+                        execute(self, entry['command'])
+                    except Exception: # A failing entry must not block startup
+                        skipped.append(entry['command'])
+        finally:
+            self.journal = journal
+            random.seed()
 
-            elif buffer.startswith('clear') or buffer.startswith('refresh'): # Clear screen
-                break
+        for command in skipped:
+            print(f'[ERROR] journal entry failed to replay, skipped: {command}')
+        print(f'restored session, replayed {len(entries) - len(skipped)} command(s)...')
+        return True
 
-            elif buffer.startswith('reload'): # Reload turn order
-                combatants.sort(key=lambda c : int(c.roll), reverse=True)
-                break
+    # Import the json encounters into a new library
+    def migrate_library(self):
+        try:
+            imported = library.migrate(self.monster_db)
+            if imported:
+                print(f'imported {len(imported)} encounter(s) into {library.path}...')
+        except (OSError, sqlite3.Error):
+            print('encounter library cannot be created...')
+
+    # Load the autosave, or the players if it cannot be read
+    def load_autosave(self):
+        try:
+            load_json('autosave', self.combatants, self.monster_db)
+            print('loaded autosave...')
+        except:
+            load_json('players', self.combatants, self.monster_db)
+            print('autosave error, loading default...')
+
+    # Execute a command under the stats recorder and profiler
+    def dispatch(self, buffer):
+        profiler = self.profiler
+        if profiler:
+            profiler.enable()
+        try:
+            return self.stats.record(buffer.split(' ')[0] or '<enter>', execute, self, buffer)
+        finally:
+            if profiler:
+                profiler.disable()
+            if self.server and buffer.startswith(JOURNAL_COMMANDS + ('hist',)):
+                self.publish()
+
+    # Serve the table to read-only viewers
+    def serve(self, address):
+        self.server = TableServer(*parse_address(address))
+        self.server.start()
+        print(f'serving table on {self.server.host}:{self.server.port}...')
+        self.publish()
+
+    def publish(self):
+        self.server.publish(self.combatants, self.session.active)
+
+    # Begin collecting a cProfile of dispatched commands
+    def start_profile(self):
+        if self.profiler:
+            print('profiler already running')
+            return
+        self.profiler = cProfile.Profile()
+        print('profiling commands...')
 
-            elif buffer.startswith('list'): # List encounter files
-                list_encounters()
+    # Stop profiling and dump the hot spots to data/
+    def stop_profile(self):
+        if not self.profiler:
+            print('profiler is not running')
+            return
+        profiler = self.profiler
+        self.profiler = None
+        profiler.disable()
+
+        path = time.strftime('data/profile_%Y%m%d_%H%M%S')
+        profiler.dump_stats(path + '.prof')
+        with open(path + '.txt', 'w') as f:
+            pstats.Stats(profiler, stream=f).sort_stats('cumulative').print_stats(50)
+        print(f'profile written to {path}.txt')
+
+# Parse and execute one command, returns True when the table should be redrawn,
+# state changing commands are journaled with their random seed
+def execute(tracker, buffer):
+    journal = tracker.journal
+    if not journal or not journal.accepts(buffer):
+        return run_command(tracker, buffer)
+
+    # Only commands that finish are journaled, one that raised would raise
+    # again on every replay
+    seed = journal.reseed()
+    result = run_command(tracker, buffer)
+    journal.append(buffer, seed)
+    if journal.due():
+        journal.compact(session_state(tracker.session))
+    return result
+
+# Dispatch one command
+def run_command(tracker, buffer):
+    combatants = tracker.combatants
+    monster_db = tracker.monster_db
+    spell_db = tracker.spell_db
+    renderer = tracker.renderer
+
+    # Buffer command and split into fields
+    command_fields = buffer.split(' ')
+    if not buffer.startswith('hist'):
+        tracker.hist.append(buffer)
+
+    # Parse and execute commands
+    if buffer == '': # Accept empty command
+        pass
+
+    elif buffer.startswith('rollall') or buffer.startswith('reroll'): # Reroll combat round
+        advance_round(combatants)
+        return True
+
+    elif buffer.startswith('clear') or buffer.startswith('refresh'): # Clear screen
+        if renderer:
+            renderer.invalidate()
+        return True
+
+    elif buffer.startswith('reload'): # Reload turn order
+        combatants.sort_initiative()
+        return True
+
+    elif buffer.startswith('list'): # List encounter files
+        list_encounters(command_fields)
+
+    elif buffer.startswith('save'): # Save current encounter
+        save_encounter(command_fields, combatants, monster_db)
+
+    elif buffer.startswith('load'): # Load existing encounter
+        load_encounter(command_fields, combatants, monster_db)
+
+    elif buffer.startswith('add'): # Add new combatant or encounter
+        add_to_encounter(command_fields, combatants, monster_db)
+
+    elif buffer.startswith('remove'): # Remove combatant from encounter
+        remove_from_encounter(command_fields, combatants)
+
+    elif buffer.startswith('edit'): # Edit combatant fields
+        edit_combatant(command_fields, combatants, tracker.session)
+
+    elif buffer.startswith('dice'): # Roll dice expression
+        roll_dice(command_fields)
+
+    elif buffer.startswith('damage'): # Damage a combatant
+        damage_combatant(command_fields, combatants, True)
+
+    elif buffer.startswith('heal'): # Heal a combatant
+        damage_combatant(command_fields, combatants, False)
+
+    elif buffer == 'roll': # Prompt for player rolls, they run inline to be journaled
+        print('order: ' + ', '.join(players_list))
+        return execute(tracker, 'roll ' + input())
+
+    elif buffer.startswith('roll'): # Roll for players en masse
+        roll_players(combatants, command_fields)
+        combatants.sort_initiative()
+
+    elif buffer.startswith('lock'): # Lock combatant roll
+        lock_combatant(command_fields, combatants)
+
+    elif buffer.startswith('help'): # Print usage for all commands
+        if len(command_fields) > 1:
+            print_help(command_fields[1])
+        else:
+            print_help('all')
+
+    elif buffer.startswith('hist'): # View and execute old commands
+        if len(command_fields) == 1 and not sys.stdin.isatty():
+            print('hist navigation needs a terminal, use hist print')
+            return False
+        hist_command = search_history(tracker.hist, command_fields)
+        if hist_command:
+            return execute(tracker, hist_command)
+
+    elif buffer.startswith('exit'): # Save and exit
+        spell_db.save_cards()
+        if tracker.profiler:
+            tracker.stop_profile()
+        journal = tracker.journal
+        tracker.journal = None
+        save_and_exit(combatants, journal)
+
+    elif buffer.startswith('shell'): # Shell subprocess
+        command = buffer[buffer.find('shell') + 5:]
+        if command == '' or command == ' ':
+            print('usage: shell <command>')
+        else:
+            os.system(command)
+            if renderer: # Subprocess output is not counted
+                renderer.invalidate()
+
+    elif buffer.startswith('bash'): # Bash subprocess
+        os.system('bash')
+        if renderer:
+            renderer.invalidate()
+
+    elif buffer.startswith('encounter'): # Switch between open encounters
+        if manage_encounters(command_fields, tracker.session):
+            if renderer: # A different encounter is repainted in full
+                renderer.invalidate()
+            return True
+
+    elif buffer.startswith('library'): # Manage the encounter library
+        manage_library(command_fields, monster_db)
+
+    elif buffer.startswith('next') or buffer.startswith('prev'): # Move the turn pointer
+        if not combatants.ordered:
+            print('no initiative order, use rollall or reload first')
+        elif buffer.startswith('next'):
+            if not combatants.next_turn(): # Last turn, roll the next round
+                advance_round(combatants)
+                print(f'round {combatants.round}')
+            return True
+        elif combatants.previous_turn():
+            return True
+        else:
+            print('already at the first turn of the round')
 
-            elif buffer.startswith('save'): # Save current encounter
-                save_encounter(command_fields, combatants)
+    elif buffer.startswith('build'): # Generate encounters from an XP budget
+        build_encounter(command_fields, combatants, monster_db, tracker.session.candidates)
 
-            elif buffer.startswith('load'): # Load existing encounter
-                load_encounter(command_fields, combatants, monster_db)
+    elif buffer.startswith('stats'): # Command timings
+        if len(command_fields) == 2 and command_fields[1] == 'reset':
+            tracker.stats.clear()
+            print('stats reset')
+        elif len(command_fields) == 1:
+            tracker.stats.report()
+        else:
+            print('usage: stats [reset]')
 
-            elif buffer.startswith('add'): # Add new combatant or encounter
-                add_to_encounter(command_fields, combatants, monster_db)
+    elif buffer.startswith('profile'): # Toggle cProfile
+        if command_fields[1:] == ['on']:
+            tracker.start_profile()
+        elif command_fields[1:] == ['off']:
+            tracker.stop_profile()
+        else:
+            print('usage: profile <on|off>')
 
-            elif buffer.startswith('remove'): # Remove combatant from encounter
-                remove_from_encounter(command_fields, combatants)
+    elif buffer.startswith('simulate'): # Simulate combat outcomes
+        simulate_encounter(command_fields, combatants, monster_db)
 
-            elif buffer.startswith('edit'): # Edit combatant fields
-                edit_combatant(command_fields, combatants)
+    elif buffer.startswith('sort'): # Sort combatants
+        sort_combatants(command_fields, combatants)
 
-            elif buffer.startswith('damage'): # Damage a combatant
-                damage_combatant(command_fields, combatants, True)
+    elif buffer.startswith('monster'): # Search monsters
+        search_monsters(command_fields, monster_db)
 
-            elif buffer.startswith('heal'): # Heal a combatant
-                damage_combatant(command_fields, combatants, False)
+    elif buffer.startswith('spellbook') or buffer.startswith('sb'):
+        manage_spellbook(command_fields, spell_db)
 
-            elif buffer.startswith('roll'): # Roll for players en masse
-                roll_players(combatants)
-                combatants.sort(key=lambda c : int(c.roll), reverse=True)
+    elif buffer.startswith('spell'): # Search spells
+        search_spells(command_fields, spell_db)
 
-            elif buffer.startswith('lock'): # Lock combatant roll
-                lock_combatant(command_fields, combatants)
+    else: # No matching command
+        print(f'{command_fields[0]}: command not found\nuse \"help\" for help')
 
-            elif buffer.startswith('help'): # Print usage for all commands
-                if len(command_fields) > 1:
-                    print_help(command_fields[1])
-                else:
-                    print_help('all')
+    # TODO: create better directory structure
+    return False
+
+# Machine readable encounter state
+def encounter_state(combatants):
+    state = []
+    for c in combatants:
+        state.append({
+            'name' : c.name,
+            'init_mod' : c.init_mod,
+            'health' : c.health,
+            'roll' : c.roll,
+            'ac' : c.ac,
+            'type' : c.type,
+            'locked' : c.locked
+        })
+    return state
+
+# Run commands from a script or piped stdin without clearing or redrawing
+def run_headless(tracker, lines, emit_json=False):
+    try:
+        for line in lines:
+            buffer = line.rstrip('\n')
+            if buffer.lstrip().startswith('#'): # Script comment
+                continue
 
-            elif buffer.startswith('hist'): # View and execute old commands
-                hist_command = search_history(hist, command_fields)
+            if not emit_json:
+                tracker.dispatch(buffer)
+                continue
 
-            elif buffer.startswith('exit'): # Save and exit
-                save_and_exit(combatants)
+            # One json record per line, the command's own output goes inside it
+            output = io.StringIO()
+            try:
+                with contextlib.redirect_stdout(output):
+                    tracker.dispatch(buffer)
+            finally:
+                print(json.dumps({'command' : buffer, 'output' : output.getvalue(), 'ms' : tracker.stats.last * 1000,
+                    'combatants' : encounter_state(tracker.combatants)}))
+    finally: # Summary also prints when the script exits
+        sys.stdout.flush()
+        tracker.stats.report(sys.stderr)
 
-            elif buffer.startswith('shell'): # Shell subprocess
-                command = buffer[buffer.find('shell') + 5:]
-                if command == '' or command == ' ':
-                    print('usage: shell <command>')
-                else:
-                    os.system(command)
+# Interactive prompt loop
+def run_interactive(tracker):
+    # Redraw changed rows in place on a terminal, print tables otherwise
+    if sys.stdout.isatty():
+        tracker.renderer = TableRenderer()
+    renderer = tracker.renderer
 
-            elif buffer.startswith('bash'): # Bash subprocess
-                os.system('bash')
+    # Primary loop
+    while(True):
+        if renderer:
+            renderer.draw(tracker.combatants)
+        else:
+            draw_all(tracker.combatants)
 
-            elif buffer.startswith('sort'): # Sort combatants
-                sort_combatants(command_fields, combatants)
+        # Command loop
+        while(True):
+            buffer = input('~$ ')
+            if not renderer:
+                if tracker.dispatch(buffer):
+                    break
+                continue
 
-            elif buffer.startswith('monster'): # Search monsters
-                search_monsters(command_fields, monster_db)
+            renderer.note_input('~$ ' + buffer)
+            with contextlib.redirect_stdout(renderer.output):
+                redraw = tracker.dispatch(buffer)
+            if redraw:
+                break
 
-            elif buffer.startswith('spellbook') or buffer.startswith('sb'):
-                manage_spellbook(command_fields, spell_db)
+# Main entrypoint
+def main():
+    parser = argparse.ArgumentParser(description='d&d 5e encounter builder and combat tracker')
+    parser.add_argument('--script', metavar='FILE', help='run commands from FILE without the interactive display')
+    parser.add_argument('--headless', action='store_true', help='run commands piped on stdin without the interactive display')
+    parser.add_argument('--json', action='store_true', help='print a json record with the output and encounter after every headless command')
+    parser.add_argument('--journal', action='store_true', help='journal headless and script runs so the next start resumes them')
+    parser.add_argument('--profile', action='store_true', help='profile startup and commands, track allocation peaks')
+    parser.add_argument('--serve', metavar='[HOST:]PORT', help='serve a read-only view of the table to --watch clients')
+    parser.add_argument('--watch', metavar='[HOST:]PORT', help='follow the table of a tracker started with --serve')
+    parser.add_argument('--daemon', action='store_true', help='keep the tracker resident behind a unix socket for thin clients')
+    parser.add_argument('--stop-daemon', action='store_true', help='save and stop the resident daemon')
+    parser.add_argument('--local', action='store_true', help='run in process even when a daemon is running')
+    parser.add_argument('command', nargs='*', help='run one command and exit, through the daemon when one is running')
+    args = parser.parse_args()
+
+    if args.watch:
+        watch_table(args.watch)
+        return
 
-            elif buffer.startswith('spell'): # Search spells
-                search_spells(command_fields, spell_db)
+    if args.stop_daemon:
+        try:
+            with connect_daemon() as sock:
+                print(daemon_request(sock.makefile('rw'), 'exit', stop=True)['output'], end='')
+        except OSError:
+            print('no daemon is running')
+        return
 
-            else: # No matching command
-                print(f'{command_fields[0]}: command not found\nuse \"help\" for help')
+    # Headless runs leave the session alone unless asked to journal
+    headless = not args.daemon and not args.command and (args.script or args.headless or not sys.stdin.isatty())
+    tracker = Tracker(args.profile, args.journal or not headless)
+    with contextlib.redirect_stdout(sys.stderr if args.json else sys.stdout): # Keep json output parseable
+        tracker.startup()
+        if args.serve:
+            try:
+                tracker.serve(args.serve)
+            except (OSError, ValueError) as e:
+                print(f'cannot serve on {args.serve}: {e}')
+
+    if args.daemon:
+        try:
+            TrackerDaemon(tracker).serve_forever()
+        except (RuntimeError, OSError) as e:
+            print(f'cannot start daemon: {e}')
+        except KeyboardInterrupt: # The journal keeps the state for the next start
+            print('daemon stopped')
+    elif args.command:
+        tracker.dispatch(' '.join(args.command))
+    elif args.script:
+        with open(args.script) as f:
+            run_headless(tracker, f, args.json)
+    elif args.headless or not sys.stdin.isatty():
+        run_headless(tracker, sys.stdin, args.json)
+    else:
+        run_interactive(tracker)
 
-            # TODO: create better directory structure
+    if tracker.profiler: # Headless runs end without exit
+        tracker.stop_profile()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
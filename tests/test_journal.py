@@ -0,0 +1,87 @@
+import os, sys, io, json, shutil, contextlib
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import combat_tracker as ct
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+DATA_FILES = ('monsters.csv', 'monsters.csv.cache', 'spells.json', 'players.json', 'autosave.json',
+              'empty.json', 'seven_snakes.json')
+
+# Tracker in a copy of data/, with its own library and player list
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    os.makedirs(tmp_path / 'data')
+    for file in DATA_FILES:
+        if os.path.exists(os.path.join(DATA, file)):
+            shutil.copy2(os.path.join(DATA, file), tmp_path / 'data' / file)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(ct, 'library', ct.EncounterLibrary())
+    monkeypatch.setattr(ct, 'players_list', ct.players_list)
+    ct.players_list.clear()
+    return tmp_path
+
+def start():
+    tracker = ct.Tracker()
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracker.startup()
+    return tracker
+
+def run(tracker, *commands):
+    with contextlib.redirect_stdout(io.StringIO()):
+        for command in commands:
+            ct.execute(tracker, command)
+
+# Stop writing as if the process died, the journal and snapshot stay behind
+def crash(tracker):
+    journal = tracker.journal
+    journal.join()
+    journal.file.close()
+    journal.lock_file.close()
+
+# Session state as a restart reads it back
+def state(tracker):
+    return json.loads(json.dumps(ct.session_state(tracker.session)))
+
+# Crash the tracker and check a fresh one recovers the same session
+def assert_recovers(tracker):
+    expected = state(tracker)
+    crash(tracker)
+    ct.players_list.clear()
+    recovered = start()
+    try:
+        assert state(recovered) == expected
+    finally:
+        crash(recovered)
+
+def test_snapshot_mid_stream(workdir, monkeypatch):
+    monkeypatch.setattr(ct, 'SNAPSHOT_INTERVAL', 3)
+    tracker = start()
+    run(tracker, 'add goblin 3', 'rollall', 'damage Goblin_2 4', 'next', 'next', 'edit Goblin roll 30',
+        'add orc', 'lock Orc', 'rollall', 'heal Goblin_2 1', 'remove Goblin_3')
+    assert tracker.journal.seq > 2 * ct.SNAPSHOT_INTERVAL
+    assert_recovers(tracker)
+
+def test_command_that_raises(workdir):
+    tracker = start()
+    run(tracker, 'add goblin 2')
+    with pytest.raises(ValueError), contextlib.redirect_stdout(io.StringIO()):
+        ct.execute(tracker, 'add zzzz x')
+    run(tracker, 'rollall', 'damage Goblin 3')
+    assert_recovers(tracker)
+
+def test_build_then_build_add(workdir):
+    tracker = start()
+    run(tracker, 'build hard level 3')
+    tracker.journal.compact(ct.session_state(tracker.session), True) # Snapshot between the two
+    run(tracker, 'build add 1')
+    assert len(tracker.combatants) > len(ct.players_list)
+    assert_recovers(tracker)
+
+def test_initiative_ties(workdir):
+    tracker = start()
+    run(tracker, 'add goblin 30', 'rollall', 'sort name', 'rollall', 'next', 'next', 'edit Goblin_7 dex 0',
+        'add goblin 5', 'remove Goblin_2', 'next')
+    rolls = [(c.roll, c.init_mod) for c in tracker.combatants]
+    assert len(set(rolls)) < len(rolls) # Ties were broken
+    assert_recovers(tracker)